@@ -1,86 +1,465 @@
 import streamlit as st
+import hashlib
 import pickle
 import pandas as pd
 import requests
 import time
 import os
+import threading
+from concurrent.futures import Future
+
+import downloads
+import similarity_store
+import title_index
+
+
+# Which similarity backend to serve: "topk" (compact neighbor table), "dense" (full matrix),
+# "sparse" (thresholded CSR matrix), "sharded" (lazily mapped row shards), a quantized copy
+# of the full matrix ("float16" or "uint8"), or one that needs no download: "tags" computes
+# scores from the movie tags, "embedding" from low-rank embeddings of them
+SIMILARITY_BACKEND = os.environ.get('SIMILARITY_BACKEND', 'topk')
+SIMILARITY_PATHS = {
+    'dense': 'similarity.npy',
+    'topk': 'similarity_topk.npz',
+    'float16': 'similarity_float16.npy',
+    'uint8': 'similarity_uint8.npy',
+    'sparse': 'similarity_sparse.npz',
+    'sharded': 'similarity_shards',
+    'embedding': 'similarity_embeddings.npy',
+    'packed': 'similarity_packed.npy',
+}
+# Name prefix of the shared memory segments that hold the engine and the movie columns, when set
+# the first server process populates them and every other process attaches instead of loading
+SIMILARITY_SHARED_MEMORY = os.environ.get('SIMILARITY_SHARED_MEMORY')
+# Comma separated places similarity.pkl is fetched from, tried in order until one of them delivers
+# a verified copy: a local path or file:// URL (e.g. a pre-baked volume), an http(s):// mirror, or
+# drive:<file id>. An entry may end in ";timeout=<seconds>", the network timeout of that source.
+SIMILARITY_SOURCES = os.environ.get('SIMILARITY_SOURCES', 'drive:1JOeVuqgULOdCAu2JmMtMogYlUEiMLZCg')
+
+
+def ensure_dense_similarity(movie_ids_sha256, status):
+    """Make sure similarity.npy exists and matches the movies, fetching it from SIMILARITY_SOURCES if necessary"""
+
+    # One process downloads and converts while the others wait for the finished file
+    with similarity_store.artifact_lock('similarity.npy', on_wait=lambda: status.info(
+            "⏳ Another process is downloading the similarity data, waiting for it...")):
+        # Published checksum, size, shape, dtype, chunk digests and movie ordering of similarity.pkl,
+        # any of which may be absent
+        manifest = similarity_store.load_manifest('similarity_manifest.json')
+
+        # A stale copy stays in place until the new version replaces it, so that the chunks
+        # the two have in common are not downloaded again. One that is only outdated, still
+        # matching the movies, keeps being served if the new version cannot be fetched.
+        previous = None
+        outdated = False
+        if os.path.exists('similarity.npy'):
+            try:
+                built = similarity_store.check_artifact_manifest('similarity.npy', 'dense', movie_ids_sha256)
+            except ValueError as e:
+                status.warning(f"⚠️ Replacing stale similarity data: {str(e)}")
+                previous = 'similarity.npy'
+            else:
+                built_sha256 = built.get('build', {}).get('sha256')
+                if manifest.get('sha256', built_sha256) == built_sha256:
+                    return True
+                status.warning("⚠️ A newer version of the similarity data has been published, refreshing it...")
+                previous = 'similarity.npy'
+                outdated = True
+
+        def give_up(*errors):
+            if outdated:
+                status.warning("⚠️ Could not refresh the similarity data, serving the previous version.")
+                return True
+            for error in errors:
+                status.error(error)
+            return False
+
+        # Fail before downloading anything if the published matrix belongs to another movie list
+        if manifest.get('movie_ids_sha256', movie_ids_sha256) != movie_ids_sha256:
+            return give_up("❌ The published similarity data was built for a different version of movies.pkl.")
+
+        if not os.path.exists('similarity.pkl'):
+            if previous and manifest.get('chunks') and manifest.get('size') and not os.path.exists('similarity.pkl.part'):
+                reused = downloads.seed_download('similarity.pkl', previous, manifest)
+                status.info(f"♻️ Reusing {reused} of {len(manifest['chunks'])} chunks of the previous similarity data")
+            status.info("📥 Downloading similarity data (this may take a moment)...")
+            if not manifest.get('sha256'):
+                # Without a published checksum nothing ties the bytes to the published file: the in-place
+                # conversion only checks the array marker and the file length against the manifest's shape
+                # and dtype, and a pickle of another layout only has to unpickle to that shape
+                message = ("similarity_manifest.json has no sha256, the downloaded similarity data cannot be "
+                           "verified. Run `python similarity_store.py manifest similarity.pkl "
+                           "similarity_manifest.json` on the published file.")
+                print(f"Warning: {message}")
+                status.warning(f"⚠️ {message}")
+
+            # A source that is unreachable, too slow or serves the wrong bytes falls through to the next
+            for source in filter(None, map(str.strip, SIMILARITY_SOURCES.split(','))):
+                try:
+                    downloads.fetch_from_source(source, 'similarity.pkl', manifest.get('sha256'), manifest.get('size'),
+                                                progress=status.set_progress)
+                    break
+                except Exception as e:
+                    status.warning(f"⚠️ Could not fetch similarity data from {source}: {str(e)}")
+                    if not manifest.get('sha256'):
+                        # The next source would resume this one's part, and no checksum could tell if their
+                        # bytes belong to the same file, so it starts over
+                        for leftover in ('similarity.pkl.part', 'similarity.pkl.part.ranges'):
+                            if os.path.exists(leftover):
+                                os.remove(leftover)
+            else:
+                return give_up("❌ Failed to download similarity data from any source.",
+                               "Please try refreshing the page or contact support.")
+
+        # The array data inside the verified pickle becomes similarity.npy right where the download
+        # wrote it, with no second pass over it. Only a pickle of an unexpected layout is
+        # deserialized, once, and checked against the manifest.
+        try:
+            shape, dtype = manifest.get('shape'), manifest.get('dtype')
+            if not (shape and dtype and similarity_store.pickle_to_npy_in_place('similarity.pkl', 'similarity.npy',
+                                                                               shape, dtype)):
+                similarity_store.convert_pickle_to_npy('similarity.pkl', 'similarity.npy',
+                                                       expected_shape=shape, expected_dtype=dtype)
+                os.remove('similarity.pkl')
+            similarity_store.write_artifact_manifest('similarity.npy', 'dense', movie_ids_sha256,
+                                                     {'source': 'similarity.pkl', 'sha256': manifest.get('sha256')})
+            if manifest.get('sha256'):
+                status.success("✅ Similarity data downloaded and verified successfully!")
+            else:
+                status.success("✅ Similarity data downloaded, its checksum could not be verified.")
+            return True
+        except Exception as verify_error:
+            if os.path.exists('similarity.pkl'):
+                os.remove('similarity.pkl')
+            return give_up(f"❌ Downloaded file is corrupted: {str(verify_error)}")
+
+
+def check_published_similarity(build):
+    """Raise ValueError if an artifact was derived from an older similarity.pkl than the published one"""
+    # Artifacts built from the movie tags do not depend on the published matrix
+    if build.get('source') == 'tags':
+        return
+    published = similarity_store.load_manifest('similarity_manifest.json').get('sha256')
+    if published and build.get('sha256') != published:
+        raise ValueError("a newer version of the similarity data has been published")
+
+
+def build_similarity_artifact(backend, path):
+    """Derive the artifact of backend from similarity.npy, returning its build parameters"""
+    if backend == 'embedding':
+        # Embeddings are projected from the movie tags, the dense matrix is not needed
+        embeddings = similarity_store.build_embeddings(similarity_store.load_column('movies.pkl', 'tags'))
+        similarity_store.save_embeddings(path, embeddings)
+        return {'source': 'tags', 'dim': embeddings.shape[1]}
+
+    dense = similarity_store.open_dense('similarity.npy')
+    # Checksum of the published pickle the dense matrix came from, checked against later releases
+    sha256 = similarity_store.load_manifest(
+        similarity_store.manifest_path('similarity.npy')).get('build', {}).get('sha256')
+
+    if backend == 'topk':
+        similarity_store.save_top_k(path, *similarity_store.build_top_k(dense))
+        return {'source': 'similarity.npy', 'sha256': sha256, 'k': similarity_store.DEFAULT_TOP_K}
+
+    if backend == 'sparse':
+        similarity_store.save_sparse(path, *similarity_store.build_sparse(dense))
+        return {'source': 'similarity.npy', 'sha256': sha256, 'min_score': 0.0,
+                'max_nnz': similarity_store.DEFAULT_MAX_NNZ}
+
+    if backend == 'sharded':
+        similarity_store.save_sharded(path, dense)
+        return {'source': 'similarity.npy', 'sha256': sha256, 'rows_per_shard': similarity_store.DEFAULT_SHARD_ROWS}
+
+    if backend == 'packed':
+        similarity_store.save_packed(path, dense)
+        return {'source': 'similarity.npy', 'sha256': sha256}
+
+    similarity_store.save_quantized(path, dense, backend)
+    return {'source': 'similarity.npy', 'sha256': sha256}
+
+
+def prepare_similarity_artifact(backend, movie_ids_sha256, status):
+    """Make sure the artifact of backend exists and was built for the movies, returning its path"""
+
+    path = SIMILARITY_PATHS[backend]
+    if backend == 'dense':
+        return path if ensure_dense_similarity(movie_ids_sha256, status) else None
+
+    # One process builds while the others wait, then find the finished artifact
+    with similarity_store.artifact_lock(path, on_wait=lambda: status.info(
+            "⏳ Another process is preparing the similarity data, waiting for it...")):
+        # Movies appended since the top-K table was built live in a delta, the table itself
+        # must then belong to the movies the delta started from
+        base_sha256 = movie_ids_sha256
+        delta = similarity_store.delta_path(path)
+        if backend == 'topk' and os.path.exists(delta):
+            try:
+                base_sha256 = similarity_store.check_top_k_delta(delta, movie_ids_sha256)
+            except ValueError as e:
+                status.warning(f"⚠️ Ignoring stale catalog update: {str(e)}")
 
+        # Only the small manifest is read here, the artifact itself is opened afterwards
+        outdated = False
+        if os.path.exists(path):
+            try:
+                built = similarity_store.check_artifact_manifest(path, backend, base_sha256)
+            except ValueError as e:
+                status.warning(f"⚠️ Rebuilding stale similarity data: {str(e)}")
+                similarity_store.remove_artifact(path)
+                base_sha256 = movie_ids_sha256
+            else:
+                try:
+                    check_published_similarity(built['build'])
+                    return path
+                except ValueError as e:
+                    # Still valid for these movies, it keeps being served until its replacement is built
+                    status.warning(f"⚠️ Refreshing similarity data: {str(e)}")
+                    outdated = True
+
+        # A compressed copy shipped next to the app is decompressed straight into memory
+        # instead of downloading and deriving from the dense matrix
+        for suffix in similarity_store.COMPRESSORS:
+            if os.path.exists(path + suffix):
+                try:
+                    built = similarity_store.check_artifact_manifest(path + suffix, backend, base_sha256)
+                    check_published_similarity(built['build'])
+                    return path + suffix
+                except ValueError as e:
+                    status.warning(f"⚠️ Ignoring stale compressed similarity data: {str(e)}")
+
+        # Derived artifacts are built the first time they are needed or when a new matrix is published,
+        # all but the embeddings from the dense matrix, which is refreshed first
+        staging = similarity_store.staging_path(path)
+        try:
+            if backend != 'embedding':
+                if not ensure_dense_similarity(base_sha256, status) and not outdated:
+                    return None
+                if outdated:
+                    # The matrix could not be refreshed, rebuilding from it would only reproduce the
+                    # artifact being served
+                    try:
+                        check_published_similarity(similarity_store.load_manifest(
+                            similarity_store.manifest_path('similarity.npy')).get('build', {}))
+                    except ValueError:
+                        return path
+
+            # Built next to the artifact being served and swapped in once complete, so that
+            # a failure leaves the previous version in place
+            build = build_similarity_artifact(backend, staging)
+            similarity_store.write_artifact_manifest(staging, backend, base_sha256, build)
+            similarity_store.replace_artifact(staging, path)
+            return path
+        except Exception as e:
+            similarity_store.remove_artifact(staging)
+            if not outdated:
+                raise
+            status.warning(f"⚠️ Could not refresh the similarity data, serving the previous version: {str(e)}")
+            return path
+
+
+def has_current_delta(backend, path, movie_ids_sha256):
+    """Whether a catalog update over the top-K table at path applies to the current movies"""
+    delta = similarity_store.delta_path(path)
+    if backend != 'topk' or not os.path.exists(delta):
+        return False
+    try:
+        similarity_store.check_top_k_delta(delta, movie_ids_sha256)
+        return True
+    except ValueError:
+        return False
 
-def download_large_file_from_google_drive(file_id, destination):
-    """Download a large file from Google Drive"""
 
-    def get_confirm_token(response):
-        for key, value in response.cookies.items():
-            if key.startswith('download_warning'):
-                return value
+def artifact_identity(path):
+    """Inode, modification time and manifest of an artifact, which change whenever it is replaced"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
         return None
+    return stat.st_ino, stat.st_mtime_ns, similarity_store.load_manifest(similarity_store.manifest_path(path))
 
-    def save_response_content(response, destination, chunk_size=32768):
-        total_size = int(response.headers.get('content-length', 0))
-        progress_bar = st.progress(0)
 
-        with open(destination, "wb") as f:
-            downloaded = 0
-            for chunk in response.iter_content(chunk_size):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    if total_size > 0:
-                        progress = downloaded / total_size
-                        progress_bar.progress(progress)
-        progress_bar.empty()
+def open_similarity_engine(backend, movie_ids_sha256, status):
+    """Open the similarity engine of the given backend, building its file if needed"""
 
-    URL = "https://docs.google.com/uc?export=download"
-    session = requests.Session()
+    path = None
+    opened = None
 
-    response = session.get(URL, params={'id': file_id}, stream=True)
-    token = get_confirm_token(response)
-
-    if token:
-        params = {'id': file_id, 'confirm': token}
-        response = session.get(URL, params=params, stream=True)
+    try:
+        if backend == 'tags':
+            return similarity_store.TagSimilarity.from_tags(similarity_store.load_column('movies.pkl', 'tags'))
 
-    save_response_content(response, destination)
+        path = prepare_similarity_artifact(backend, movie_ids_sha256, status)
+        if path is None:
+            return None
+        opened = artifact_identity(path)
+        # Dense and quantized matrices are memory-mapped, rows are paged in only when recommend() reads them
+        engine = similarity_store.open_artifact(path, backend)
+        if has_current_delta(backend, path, movie_ids_sha256):
+            delta = similarity_store.open_top_k_delta(similarity_store.delta_path(path))
+            engine = similarity_store.apply_top_k_delta(engine, delta)
+        return engine
+    except Exception as e:
+        status.error(f"❌ Error loading similarity data: {str(e)}")
+        if path:
+            # Another process may have rebuilt the artifact meanwhile, only the copy that failed to open is removed
+            with similarity_store.artifact_lock(SIMILARITY_PATHS[backend]):
+                if opened is not None and artifact_identity(path) == opened:
+                    similarity_store.remove_artifact(path)
+        return None
 
 
-@st.cache_data
-def load_similarity_data():
+def load_similarity_data(backend, movie_ids_sha256, status):
     """Load similarity data, downloading from Google Drive if necessary"""
 
-    file_id = "1JOeVuqgULOdCAu2JmMtMogYlUEiMLZCg"
+    # Shards are mapped lazily from files, their pages are already shared through the page cache
+    if not SIMILARITY_SHARED_MEMORY or backend == 'sharded':
+        return open_similarity_engine(backend, movie_ids_sha256, status)
 
-    if not os.path.exists('similarity.pkl'):
-        st.info("📥 Downloading similarity data from Google Drive (this may take a moment)...")
+    # Segments are keyed by the artifact manifest, a rebuilt artifact never attaches to stale data
+    if backend == 'tags':
+        # Tag vectors are computed from movies.pkl itself, edited tags change them as much as new movies
+        key, _ = similarity_store.file_digest('movies.pkl')
+    else:
+        path = prepare_similarity_artifact(backend, movie_ids_sha256, status)
+        if path is None:
+            return None
+        key, _ = similarity_store.file_digest(similarity_store.manifest_path(path))
+        if has_current_delta(backend, path, movie_ids_sha256):
+            delta_key, _ = similarity_store.file_digest(
+                similarity_store.manifest_path(similarity_store.delta_path(path)))
+            key = hashlib.sha256((key + delta_key).encode()).hexdigest()
+
+    def load_engine():
+        engine = open_similarity_engine(backend, movie_ids_sha256, status)
+        if engine is None:
+            raise RuntimeError("similarity data is unavailable")
+        return engine
+
+    # A new version of the segment replaces the previous one of this backend, which is unlinked
+    prefix = f"{SIMILARITY_SHARED_MEMORY}-{backend}"
+    try:
+        return similarity_store.share_engine(f"{prefix}-{key[:12]}", load_engine, replaces=prefix)
+    except Exception as e:
+        status.error(f"❌ Error attaching to shared similarity data: {str(e)}")
+        return None
 
-        try:
-            download_large_file_from_google_drive(file_id, 'similarity.pkl')
 
-            # Verify the file was downloaded correctly
-            try:
-                with open('similarity.pkl', 'rb') as f:
-                    test_load = pickle.load(f)
-                st.success("✅ Similarity data downloaded and verified successfully!")
-            except Exception as verify_error:
-                st.error(f"❌ Downloaded file is corrupted: {str(verify_error)}")
-                if os.path.exists('similarity.pkl'):
-                    os.remove('similarity.pkl')
-                return None
+class LoadStatus:
+    """Messages and download progress of a similarity load running off the script thread
+
+    Streamlit elements can only be created from a script run, so the loader
+    records what it wants to show and every session renders it.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.progress = None
+        self.started = None
+
+    def info(self, text):
+        self.messages.append(('info', text))
+
+    def success(self, text):
+        self.messages.append(('success', text))
+
+    def warning(self, text):
+        self.messages.append(('warning', text))
+
+    def error(self, text):
+        self.messages.append(('error', text))
+
+    def set_progress(self, downloaded, total):
+        now = time.monotonic()
+        if self.progress is None:
+            # Bytes resumed from an earlier attempt do not count towards the transfer rate
+            self.started = (now, downloaded)
+        self.progress = (downloaded, total, now)
+
+    def progress_text(self):
+        """Downloaded size, transfer rate and estimated time left"""
+        downloaded, total, now = self.progress
+        started_at, started_with = self.started
+        text = f"{downloaded / 1e6:.0f} of {total / 1e6:.0f} MB"
+        if now > started_at and downloaded > started_with:
+            rate = (downloaded - started_with) / (now - started_at)
+            text += f" at {rate / 1e6:.1f} MB/s, about {(total - downloaded) / rate:.0f}s left"
+        return text
+
+    def render(self):
+        for level, text in list(self.messages):
+            getattr(st, level)(text)
+        # Read at the pace of the polling fragment, not once per downloaded chunk
+        progress = self.progress
+        if progress is not None and progress[0] < progress[1]:
+            st.progress(progress[0] / progress[1], text=self.progress_text())
 
+
+class SimilarityWarmup:
+    """Loads the similarity engine on a background thread, the page stays usable meanwhile"""
+
+    def __init__(self, backend, movie_ids_sha256):
+        self.status = LoadStatus()
+        self.future = Future()
+        thread = threading.Thread(target=self._run, args=(backend, movie_ids_sha256),
+                                  name='similarity-warmup', daemon=True)
+        thread.start()
+
+    def _run(self, backend, movie_ids_sha256):
+        try:
+            self.future.set_result(load_similarity_data(backend, movie_ids_sha256, self.status))
         except Exception as e:
-            st.error(f"❌ Failed to download similarity data: {str(e)}")
-            st.error("Please try refreshing the page or contact support.")
-            return None
+            self.status.error(f"❌ Error loading similarity data: {str(e)}")
+            self.future.set_result(None)
+
+    def ready(self):
+        return self.future.done()
+
+    def engine(self):
+        """The loaded engine, None while loading or if loading failed"""
+        return self.future.result() if self.ready() else None
+
+
+# cache_resource keeps a single read-only engine per process that every session shares,
+# cache_data would hand each caller its own deserialized copy of the matrix
+@st.cache_resource(show_spinner=False)
+def start_similarity_warmup(backend, movie_ids_sha256):
+    """Start loading the similarity engine once per process"""
+    return SimilarityWarmup(backend, movie_ids_sha256)
+
+
+@st.cache_resource(show_spinner=False)
+def load_fallback_similarity():
+    """Tag-based engine used while the configured one is still loading"""
+    return similarity_store.TagSimilarity.from_tags(similarity_store.load_column('movies.pkl', 'tags'))
 
-    # Load the similarity matrix
-    try:
-        with open('similarity.pkl', 'rb') as f:
-            similarity = pickle.load(f)
-        return similarity
-    except Exception as e:
-        st.error(f"❌ Error loading similarity data: {str(e)}")
-        if os.path.exists('similarity.pkl'):
-            os.remove('similarity.pkl')
-        return None
+
+@st.cache_resource(show_spinner=False)
+def load_movies_data():
+    """Load the movies table once per process"""
+
+    def read_movies():
+        with open('movies.pkl', 'rb') as f:
+            return pd.DataFrame(pickle.load(f))
+
+    if not SIMILARITY_SHARED_MEMORY:
+        return read_movies()
+
+    # Only the columns the interface needs are shared, tags stay on disk
+    def build():
+        movies = read_movies()
+        return {}, {'movie_id': movies['movie_id'].to_numpy(), 'title': movies['title'].to_numpy(dtype=str)}
+
+    key, _ = similarity_store.file_digest('movies.pkl')
+    prefix = f"{SIMILARITY_SHARED_MEMORY}-movies"
+    _, columns = similarity_store.share_arrays(f"{prefix}-{key[:12]}", build, replaces=prefix)
+    return pd.DataFrame(columns, copy=False)
+
+
+@st.cache_resource(show_spinner=False)
+def load_title_index():
+    """Index the titles of the movies table once per process"""
+    movies = load_movies_data()
+    return title_index.TitleIndex(movies['title'].tolist(), movies['movie_id'].tolist())
 
 
 def fetch_poster(movie_id):
@@ -101,11 +480,11 @@ def fetch_poster(movie_id):
         return "https://via.placeholder.com/500x750?text=No+Poster"
 
 
-def recommend(movie, movies, similarity):
+def recommend(movie, movies, similarity, titles):
     try:
-        movie_index = movies[movies['title'] == movie].index[0]
-        distances = similarity[movie_index]
-        movies_list = sorted(list(enumerate(distances)), reverse=True, key=lambda x: x[1])[1:6]
+        # Rows of the similarity data are positions in the movies table, not its index labels
+        movie_index = titles.position(movie)
+        movies_list = similarity.neighbors(movie_index, 5)
 
         recommended_movies = []
         recommended_movies_posters = []
@@ -144,8 +523,8 @@ st.write("Select a movie and get personalized recommendations with posters!")
 
 # Load movies data (should be in the repository)
 try:
-    movies_dict = pickle.load(open('movies.pkl', 'rb'))
-    movies = pd.DataFrame(movies_dict)
+    movies = load_movies_data()
+    titles = load_title_index()
 except FileNotFoundError:
     st.error("❌ movies.pkl not found. Please make sure it's uploaded to your repository.")
     st.stop()
@@ -153,23 +532,51 @@ except Exception as e:
     st.error(f"❌ Error loading movies data: {str(e)}")
     st.stop()
 
-# Load similarity data (download from Google Drive if needed)
-with st.spinner("Loading similarity data..."):
-    similarity = load_similarity_data()
+# Load similarity data in the background (download from Google Drive if needed)
+warmup = start_similarity_warmup(SIMILARITY_BACKEND, similarity_store.movie_ids_digest(movies['movie_id']))
 
-if similarity is None:
+
+# Polls while loading. Once the engine is ready the whole page reruns, which removes the status,
+# shows a failure right away and stops polling. The button reads the engine directly.
+similarity_loading = not warmup.ready()
+
+
+@st.fragment(run_every=1 if similarity_loading else None)
+def show_similarity_status():
+    if warmup.ready():
+        if similarity_loading:
+            st.rerun(scope="app")
+        return
+    warmup.status.render()
+    st.caption("⏳ Loading similarity data in the background, you can already pick a movie.")
+
+
+show_similarity_status()
+
+if warmup.ready() and warmup.engine() is None:
+    warmup.status.render()
+    # Don't keep the failure cached, the next refresh should try again
+    start_similarity_warmup.clear()
     st.error("❌ Could not load similarity data. Please try refreshing the page.")
     st.stop()
 
 # Main app interface
 selected_movie_name = st.selectbox(
     "Please Select a Movie:",
-    movies['title'].values
+    titles.options
 )
 
 if st.button('🎯 Get Recommendations'):
+    similarity = warmup.engine()
+    if similarity is None and SIMILARITY_BACKEND == 'tags':
+        with st.spinner("Loading similarity data..."):
+            similarity = warmup.future.result()
+    elif similarity is None:
+        st.info("ℹ️ Similarity data is still loading, these recommendations are based on movie tags only.")
+        similarity = load_fallback_similarity()
+
     with st.spinner('Finding similar movies and fetching posters...'):
-        names, posters = recommend(selected_movie_name, movies, similarity)
+        names, posters = recommend(selected_movie_name, movies, similarity, titles)
 
     if names and posters and len(names) == 5:
         st.success(f"Movies similar to '{selected_movie_name}':")
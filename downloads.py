@@ -0,0 +1,315 @@
+"""Fetching large files, used for the published similarity.pkl
+
+Downloads are written to ``<destination>.part`` and only renamed into place
+once complete and verified against the expected checksum and size. Byte
+ranges finished so far are recorded in ``<destination>.part.ranges``, one
+``<start> <end>`` pair per line, so an interrupted download resumes with
+the ranges still missing.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+import requests
+
+import similarity_store
+
+# Network timeout of a source that does not set its own, in seconds
+DEFAULT_SOURCE_TIMEOUT = 30
+
+
+def download_large_file(url, destination, params=None, expected_sha256=None, expected_size=None,
+                        progress=None, retries=3, workers=4, range_size=8 << 20,
+                        progress_interval=0.5, timeout=None):
+    """Download a large file over HTTP, verifying its checksum
+
+    The file is written to <destination>.part and only renamed to destination once it
+    is complete and verified. When the server supports Range requests, the file is
+    split into range_size byte ranges fetched by a pool of workers, each written in
+    place into the preallocated part. Finished ranges are recorded next to the part,
+    so a download interrupted in this or an earlier session only fetches the ranges
+    still missing. Otherwise the file streams in sequentially, and a part left by a
+    dropped connection is resumed from its end.
+    progress, when given, is called with the bytes downloaded so far and the total
+    size, at most once every progress_interval seconds and once more at the end, so
+    the transfer loops never wait on whoever displays it. timeout is the connect and
+    read timeout of every request, in seconds.
+    Google Drive's confirmation step for large files is followed when it shows up.
+    """
+
+    part_path = destination + '.part'
+    ranges_path = part_path + '.ranges'
+    last_report = [0.0]
+
+    def report(downloaded, total_size):
+        now = time.monotonic()
+        if progress and total_size > 0 and (now - last_report[0] >= progress_interval or downloaded >= total_size):
+            last_report[0] = now
+            progress(min(downloaded, total_size), total_size)
+
+    def get_confirm_token(response):
+        for key, value in response.cookies.items():
+            if key.startswith('download_warning'):
+                return value
+        return None
+
+    def request_file(session, headers):
+        response = session.get(url, params=params, headers=headers, stream=True, timeout=timeout)
+        token = get_confirm_token(response)
+
+        if token:
+            response.close()
+            params['confirm'] = token
+            response = session.get(url, params=params, headers=headers, stream=True, timeout=timeout)
+        return response
+
+    def probe_size(session):
+        """Total size of the file if the server serves byte ranges of it, else None"""
+        try:
+            with request_file(session, {'Range': 'bytes=0-0'}) as response:
+                match = re.fullmatch(r'bytes 0-0/(\d+)', response.headers.get('Content-Range', ''))
+                if response.status_code != 206 or not match:
+                    return None
+                return int(match.group(1))
+        except requests.RequestException:
+            return None
+
+    def save_response_content(response, offset, digest, chunk_size=32768):
+        total_size = expected_size or offset + int(response.headers.get('content-length', 0))
+
+        with open(part_path, "r+b" if offset else "w+b") as f:
+            # Hash the bytes kept from an earlier attempt so the checksum covers the whole file
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+
+            downloaded = offset
+            for chunk in response.iter_content(chunk_size):
+                if chunk:
+                    f.write(chunk)
+                    digest.update(chunk)
+                    downloaded += len(chunk)
+                    report(downloaded, total_size)
+        return downloaded
+
+    def download_sequentially(session):
+        if os.path.exists(ranges_path):
+            # A part preallocated for ranges has holes, it cannot be resumed from its end
+            os.remove(ranges_path)
+            os.remove(part_path)
+
+        for attempt in range(retries + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if expected_size is not None and offset > expected_size:
+                offset = 0
+
+            try:
+                response = request_file(session, {'Range': f'bytes={offset}-'} if offset else {})
+                if offset and response.status_code == 416:
+                    # The part already holds the whole file, only the rename was missing
+                    response.close()
+                    return similarity_store.file_digest(part_path)
+                response.raise_for_status()
+                if response.status_code != 206 or not response.headers.get('Content-Range', '').startswith(
+                        f'bytes {offset}-'):
+                    # The server sent the whole file instead of the requested range
+                    offset = 0
+                digest = hashlib.sha256()
+                downloaded = save_response_content(response, offset, digest)
+            except requests.RequestException:
+                if attempt == retries:
+                    raise
+                time.sleep(2 ** attempt)
+                continue
+
+            if expected_size is None or downloaded >= expected_size:
+                return digest.hexdigest(), downloaded
+        raise ValueError(f"Expected {expected_size} bytes, received {downloaded}")
+
+    def download_ranges(session, total_size, chunk_size=1 << 20):
+        # Ranges finished by an earlier attempt, a part without a record was written sequentially
+        done = []
+        if os.path.exists(part_path) and os.path.exists(ranges_path):
+            with open(ranges_path) as f:
+                done = [tuple(map(int, line.split())) for line in f if line.strip()]
+        else:
+            if os.path.exists(part_path) and os.path.getsize(part_path) <= total_size:
+                done = [(0, os.path.getsize(part_path))]
+            # Start a fresh record, one without its part describes nothing
+            open(ranges_path, 'w').close()
+        with open(part_path, 'ab') as f:
+            f.truncate(total_size)
+
+        missing, position = [], 0
+        for start, end in sorted(done) + [(total_size, total_size)]:
+            missing.extend((offset, min(offset + range_size, start)) for offset in range(position, start, range_size))
+            position = max(position, end)
+
+        lock = threading.Lock()
+        received = [total_size - sum(end - start for start, end in missing)]
+
+        # SHA-256 cannot be computed out of order. The finished prefix of the file is hashed while
+        # later ranges are still downloading, read back from the page cache it was just written to,
+        # so no pass over the whole file is left once the last range arrives.
+        finished = list(done)
+        digest = hashlib.sha256()
+        hashed = [0]
+        hash_lock = threading.Lock()
+
+        def hash_prefix():
+            while True:
+                with lock:
+                    stop = max((min(end, total_size) for start, end in finished if start <= hashed[0] < end),
+                               default=None)
+                if stop is None:
+                    return
+                while hashed[0] < stop:
+                    chunk = os.pread(fd, min(chunk_size, stop - hashed[0]), hashed[0])
+                    if not chunk:
+                        raise ValueError(f"{part_path} ended after {hashed[0]} bytes")
+                    digest.update(chunk)
+                    hashed[0] += len(chunk)
+
+        def fetch(start, end):
+            position = start
+            for attempt in range(retries + 1):
+                try:
+                    headers = {'Range': f'bytes={position}-{end - 1}'}
+                    with session.get(url, params=params, headers=headers, stream=True, timeout=timeout) as response:
+                        if response.status_code != 206:
+                            raise requests.HTTPError(f"Range request answered with {response.status_code}")
+                        for chunk in response.iter_content(chunk_size):
+                            os.pwrite(fd, chunk, position)
+                            position += len(chunk)
+                            with lock:
+                                received[0] += len(chunk)
+                                report(received[0], total_size)
+                    if position >= end:
+                        break
+                except requests.RequestException:
+                    if attempt == retries:
+                        raise
+                    time.sleep(2 ** attempt)
+            if position < end:
+                raise ValueError(f"Range {start}-{end - 1} ended after {position - start} bytes")
+            with lock:
+                with open(ranges_path, 'a') as f:
+                    f.write(f"{start} {end}\n")
+                finished.append((start, end))
+            # Whoever finds the hash idle extends it, the others go on downloading
+            if hash_lock.acquire(blocking=False):
+                try:
+                    hash_prefix()
+                finally:
+                    hash_lock.release()
+
+        fd = os.open(part_path, os.O_RDWR)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(fetch, start, end) for start, end in missing]
+                try:
+                    for future in futures:
+                        future.result()
+                except Exception:
+                    # Give up on the ranges not started yet, the finished ones stay recorded
+                    for future in futures:
+                        future.cancel()
+                    raise
+            # Ranges finished while the hash was busy with an earlier one
+            hash_prefix()
+        finally:
+            os.close(fd)
+
+        if hashed[0] != total_size:
+            raise ValueError(f"Only {hashed[0]} of {total_size} bytes of {part_path} were downloaded")
+        os.remove(ranges_path)
+        return digest.hexdigest(), total_size
+
+    session = requests.Session()
+    params = dict(params or {})
+
+    total_size = probe_size(session) if workers > 1 else None
+    if total_size is not None and expected_size is not None and total_size != expected_size:
+        raise ValueError(f"Expected {expected_size} bytes, the server has {total_size}")
+    if total_size:
+        checksum, downloaded = download_ranges(session, total_size)
+    else:
+        checksum, downloaded = download_sequentially(session)
+
+    if expected_size is not None and downloaded != expected_size:
+        os.remove(part_path)
+        raise ValueError(f"Expected {expected_size} bytes, received {downloaded}")
+    if expected_sha256 is not None and checksum != expected_sha256:
+        os.remove(part_path)
+        raise ValueError(f"Checksum mismatch, expected sha256 {expected_sha256}, got {checksum}")
+    os.replace(part_path, destination)
+
+
+def download_large_file_from_google_drive(file_id, destination, expected_sha256=None, expected_size=None,
+                                          progress=None, timeout=None):
+    """Download a large file from Google Drive, verifying its checksum"""
+    download_large_file("https://docs.google.com/uc?export=download", destination, params={'id': file_id},
+                        expected_sha256=expected_sha256, expected_size=expected_size, progress=progress,
+                        timeout=timeout)
+
+
+def copy_local_file(path, destination, expected_sha256=None, expected_size=None, progress=None, chunk_size=1 << 20):
+    """Copy a file from a local path or mounted volume, verifying its checksum while it is read"""
+    part_path = destination + '.part'
+    total_size = os.path.getsize(path)
+    digest = hashlib.sha256()
+    copied = 0
+
+    with open(path, 'rb') as source, open(part_path, 'wb') as target:
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            target.write(chunk)
+            digest.update(chunk)
+            copied += len(chunk)
+            if progress:
+                progress(copied, total_size)
+    if os.path.exists(part_path + '.ranges'):
+        # The part no longer holds the ranges a download recorded for it
+        os.remove(part_path + '.ranges')
+
+    if expected_size is not None and copied != expected_size:
+        os.remove(part_path)
+        raise ValueError(f"Expected {expected_size} bytes, found {copied}")
+    if expected_sha256 is not None and digest.hexdigest() != expected_sha256:
+        os.remove(part_path)
+        raise ValueError(f"Checksum mismatch, expected sha256 {expected_sha256}, got {digest.hexdigest()}")
+    os.replace(part_path, destination)
+
+
+def fetch_from_source(source, destination, expected_sha256=None, expected_size=None, progress=None):
+    """Fetch a file from one entry of SIMILARITY_SOURCES"""
+    spec, _, timeout = source.strip().partition(';timeout=')
+    timeout = float(timeout) if timeout else DEFAULT_SOURCE_TIMEOUT
+
+    if spec.startswith('drive:'):
+        download_large_file_from_google_drive(spec[len('drive:'):], destination, expected_sha256, expected_size,
+                                              progress, timeout=timeout)
+    elif spec.startswith(('http://', 'https://')):
+        download_large_file(spec, destination, expected_sha256=expected_sha256, expected_size=expected_size,
+                            progress=progress, timeout=timeout)
+    else:
+        path = url2pathname(urlparse(spec).path) if spec.startswith('file://') else spec
+        copy_local_file(path, destination, expected_sha256, expected_size, progress)
+
+
+def seed_download(destination, previous, manifest):
+    """Prefill the part file of a download with the chunks an older local copy already holds
+
+    They are recorded as finished ranges, so the parallel download only fetches
+    the chunks that changed. Returns the number of chunks reused.
+    """
+    part_path = destination + '.part'
+    written = similarity_store.copy_matching_chunks(previous, part_path, manifest['chunks'],
+                                                    manifest['chunk_size'], manifest['size'])
+    with open(part_path + '.ranges', 'w') as f:
+        for start, end in written:
+            f.write(f"{start} {end}\n")
+    return len(written)
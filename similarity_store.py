@@ -0,0 +1,1590 @@
+"""Storage backends for the movie similarity matrix
+
+The Streamlit app only needs a handful of neighbors per recommendation, so
+the matrix is kept on disk as a raw ``.npy`` file that is memory-mapped
+instead of being unpickled into every process. It can be reduced further to
+a compact table holding only the top-K neighbors of every movie, stored
+as its upper triangle since it is symmetric, quantized to float16 /
+per-row scaled uint8, thresholded into a sparse CSR matrix, or split into
+row shards that are mapped lazily through a bounded LRU. Any in-memory
+artifact can also be packed into an lzma or zlib stream that is
+decompressed straight into preallocated arrays.
+Similarity can also be computed on demand from the sparse tag vectors of
+movies.pkl, or from low-rank embeddings of them, with no n x n matrix at all.
+
+Every serving artifact has a ``<file>.manifest.json`` sidecar recording its
+format version, array shapes and dtypes, build parameters and a hash of the
+movie_id ordering it was built for, so the app can reject an artifact that
+does not belong to the current movies.pkl before opening it.
+
+New movies can be appended without a full rebuild: only their rows are
+scored and the top-K table gets a ``.delta.npz`` sidecar holding the new
+rows and the patched neighbor lists of existing movies, applied on load.
+
+Every backend exposes ``neighbors(index, k)`` returning ``(index, score)``
+pairs ordered from most to least similar, excluding the movie itself, and
+``arrays()`` returning the arrays it is built from so that it can be placed
+in shared memory and reattached by other server processes.
+
+Usage:
+    python similarity_store.py convert similarity.pkl similarity.npy
+    python similarity_store.py topk similarity.npy similarity_topk.npz --k 50
+    python similarity_store.py build movies.pkl similarity_topk.npz --k 50 --block-size 256
+    python similarity_store.py sparse similarity.npy similarity_sparse.npz --min-score 0.05 --max-nnz 500
+    python similarity_store.py append movies.pkl similarity_topk.npz new_movies.json
+    python similarity_store.py compress similarity_topk.npz similarity_topk.npz.xz --kind topk
+    python similarity_store.py shard similarity.npy similarity_shards --rows-per-shard 1024
+    python similarity_store.py embed movies.pkl similarity_embeddings.npy --dim 128 --reference similarity.npy
+    python similarity_store.py pack similarity.npy similarity_packed.npy
+    python similarity_store.py quantize similarity.npy similarity_uint8.npy --precision uint8
+    python similarity_store.py compare similarity.npy similarity_uint8.npy
+    python similarity_store.py manifest similarity.pkl similarity_manifest.json
+    python similarity_store.py unshare movie-recommender-topk
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import pickle
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks on Windows, artifacts are then prepared without coordination
+    fcntl = None
+
+# Bumped whenever the layout of a serving artifact changes
+FORMAT_VERSION = 1
+DEFAULT_TOP_K = 50
+PRECISIONS = ('float16', 'uint8')
+DEFAULT_MAX_FEATURES = 5000
+WEIGHTINGS = ('count', 'tfidf')
+DEFAULT_MAX_NNZ = 500
+DEFAULT_EMBEDDING_DIM = 128
+DEFAULT_SHARD_ROWS = 1024
+DEFAULT_SHARD_CACHE = 8
+DEFAULT_CHUNK_SIZE = 1 << 20
+# Stream compressors for packed artifacts, picked by file extension
+COMPRESSORS = {'.xz': lzma.open, '.gz': gzip.open}
+TOKEN_PATTERN = re.compile(r'\b\w\w+\b')
+
+
+def load_manifest(path):
+    """Read an artifact manifest, returning an empty dict if there is none"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """SHA-256 hex digest and size in bytes of a file, read in chunks"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def _dump_manifest(manifest, path):
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.write('\n')
+
+
+def movie_ids_digest(movie_ids):
+    """SHA-256 of the movie_id ordering, identifies the row order of an artifact"""
+    return hashlib.sha256(np.asarray(movie_ids, dtype='<i8').tobytes()).hexdigest()
+
+
+def chunk_digests(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """SHA-256 hex digest of every chunk_size block of a file, the last one possibly shorter"""
+    with open(path, 'rb') as f:
+        return [hashlib.sha256(chunk).hexdigest() for chunk in iter(lambda: f.read(chunk_size), b'')]
+
+
+def copy_matching_chunks(source_path, destination_path, chunks, chunk_size, size):
+    """Fill the blocks of a new file that an older local file already holds
+
+    chunks lists the digests of the new file's chunk_size blocks. A block is
+    copied from source_path wherever an aligned block with the same digest
+    sits there, so shifted or reordered blocks are found too. destination_path
+    is created with the full size, and the (start, end) byte ranges written
+    are returned.
+    """
+    offsets = {digest: number * chunk_size for number, digest in enumerate(chunk_digests(source_path, chunk_size))}
+    written = []
+    with open(source_path, 'rb') as source, open(destination_path, 'w+b') as destination:
+        destination.truncate(size)
+        for number, digest in enumerate(chunks):
+            if digest not in offsets:
+                continue
+            start = number * chunk_size
+            source.seek(offsets[digest])
+            destination.seek(start)
+            destination.write(source.read(min(chunk_size, size - start)))
+            written.append((start, min(start + chunk_size, size)))
+    return written
+
+
+def write_manifest(pickle_path, manifest_path, movies_path=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Record the checksum, size, shape and dtype of a pickled matrix in a manifest
+
+    With movies_path, the row count and movie_id ordering it was built for
+    are recorded too, so a mismatch is caught before downloading it. The
+    digests of its chunk_size blocks let a node holding an older version
+    fetch only the blocks that changed.
+    """
+    manifest = load_manifest(manifest_path)
+    manifest['format_version'] = FORMAT_VERSION
+    manifest['sha256'], manifest['size'] = file_digest(pickle_path)
+    manifest['chunk_size'] = chunk_size
+    manifest['chunks'] = chunk_digests(pickle_path, chunk_size)
+    with open(pickle_path, 'rb') as f:
+        similarity = np.asarray(pickle.load(f))
+    manifest['shape'] = list(similarity.shape)
+    manifest['dtype'] = str(similarity.dtype)
+    if movies_path:
+        movie_ids = load_column(movies_path, 'movie_id')
+        manifest['rows'] = len(movie_ids)
+        manifest['movie_ids_sha256'] = movie_ids_digest(movie_ids)
+
+    _dump_manifest(manifest, manifest_path)
+    return manifest
+
+
+def manifest_path(path):
+    """Sidecar manifest of a serving artifact"""
+    return path + '.manifest.json'
+
+
+def write_artifact_manifest(path, kind, movie_ids_sha256, build=None):
+    """Describe a serving artifact so loaders can validate it without opening it"""
+    engine = open_artifact(path, kind)
+    if isinstance(engine, ShardedSimilarity):
+        # Shards are opened lazily, describe the logical matrix instead
+        arrays = {'matrix': {'shape': [len(engine), len(engine)], 'dtype': engine.dtype.str}}
+    else:
+        arrays = {name: {'shape': list(array.shape), 'dtype': array.dtype.str}
+                  for name, array in engine.arrays().items()}
+    manifest = {
+        'format': kind,
+        'format_version': FORMAT_VERSION,
+        'rows': len(engine),
+        'movie_ids_sha256': movie_ids_sha256,
+        'arrays': arrays,
+        'build': build or {},
+    }
+    _dump_manifest(manifest, manifest_path(path))
+    return manifest
+
+
+def check_artifact_manifest(path, kind, movie_ids_sha256):
+    """Raise ValueError unless path holds a current artifact of kind built for these movies"""
+    manifest = load_manifest(manifest_path(path))
+    if not manifest:
+        raise ValueError(f"{path} has no manifest")
+    if manifest.get('format') != kind or manifest.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"{path} is a {manifest.get('format')} v{manifest.get('format_version')} artifact, "
+                         f"expected {kind} v{FORMAT_VERSION}")
+    if manifest.get('movie_ids_sha256') != movie_ids_sha256:
+        raise ValueError(f"{path} was built for a different movie list ({manifest.get('rows')} rows)")
+    return manifest
+
+
+def remove_artifact(path):
+    """Delete a serving artifact together with its sidecar files"""
+    delta = delta_path(path)
+    for candidate in (path, _scale_path(path), manifest_path(path), delta, manifest_path(delta)):
+        if os.path.isdir(candidate):
+            shutil.rmtree(candidate)
+        elif os.path.exists(candidate):
+            os.remove(candidate)
+
+
+def staging_path(path):
+    """Name an artifact is built under before replace_artifact moves it over path"""
+    root, extension = os.path.splitext(path)
+    return root + '.staging' + extension
+
+
+def replace_artifact(staged_path, path):
+    """Move an artifact built at staged_path, with its sidecar files, over the one at path
+
+    Processes that opened the previous files keep their mappings of them. The
+    manifest is moved last, so it never describes data that is not in place.
+    """
+    for source, target in ((_scale_path(staged_path), _scale_path(path)), (staged_path, path),
+                           (manifest_path(staged_path), manifest_path(path))):
+        if not os.path.exists(source):
+            continue
+        if os.path.isdir(source) and os.path.isdir(target):
+            # A directory cannot be renamed over another one, the previous one is moved aside first
+            previous = target + '.previous'
+            if os.path.exists(previous):
+                shutil.rmtree(previous)
+            os.replace(target, previous)
+            os.replace(source, target)
+            shutil.rmtree(previous)
+        else:
+            os.replace(source, target)
+
+
+@contextmanager
+def artifact_lock(path, on_wait=None):
+    """Hold an exclusive lock on <path>.lock, shared by every process and thread on the machine
+
+    Whoever holds it is the only one downloading or building path, the others
+    block until it is released and then find the finished artifact. on_wait,
+    when given, is called once if the lock is already taken.
+    """
+    with open(path + '.lock', 'a') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if on_wait:
+                    on_wait()
+                fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def open_artifact(path, kind):
+    """Open a serving artifact of the given kind"""
+    if os.path.splitext(path)[1] in COMPRESSORS:
+        return open_compressed(path)
+    if kind == 'sharded':
+        return open_sharded(path)
+    if kind == 'topk':
+        return open_top_k(path)
+    if kind == 'sparse':
+        return open_sparse(path)
+    if kind in PRECISIONS:
+        return open_quantized(path)
+    if kind == 'embedding':
+        return open_embeddings(path)
+    if kind == 'packed':
+        return open_packed(path)
+    if kind == 'dense':
+        return DenseSimilarity(open_dense(path))
+    raise ValueError(f"Unknown artifact format {kind!r}")
+
+
+def convert_pickle_to_npy(pickle_path, npy_path, expected_shape=None, expected_dtype=None):
+    """Convert a pickled similarity matrix into a raw .npy file"""
+    with open(pickle_path, 'rb') as f:
+        similarity = np.ascontiguousarray(pickle.load(f))
+
+    if similarity.ndim != 2 or similarity.shape[0] != similarity.shape[1]:
+        raise ValueError(f"Expected a square similarity matrix, got shape {similarity.shape}")
+    if expected_shape is not None and similarity.shape != tuple(expected_shape):
+        raise ValueError(f"Expected shape {tuple(expected_shape)}, got {similarity.shape}")
+    if expected_dtype is not None and similarity.dtype != np.dtype(expected_dtype):
+        raise ValueError(f"Expected dtype {expected_dtype}, got {similarity.dtype}")
+
+    # Write to a temporary file first so a crash never leaves a truncated .npy behind
+    tmp_path = npy_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, similarity)
+    os.replace(tmp_path, npy_path)
+    return similarity.shape
+
+
+def _pickled_array_offset(path, nbytes, head_size=1 << 16):
+    """Offset of the nbytes of raw data of a C-ordered ndarray pickle, None if not recognized"""
+    with open(path, 'rb') as f:
+        head = f.read(head_size)
+    # Protocols 3 and 4 store the data as one BINBYTES or BINBYTES8 opcode right after
+    # the fortran_order=False flag of the array state
+    for opcode, size_format in ((b'B', '<I'), (b'\x8e', '<Q')):
+        if nbytes >= 1 << (8 * struct.calcsize(size_format)):
+            continue
+        marker = b'\x89' + opcode + struct.pack(size_format, nbytes)
+        position = head.find(marker)
+        if position >= 0:
+            return position + len(marker)
+    return None
+
+
+def pickle_to_npy_in_place(pickle_path, npy_path, shape, dtype):
+    """Turn a downloaded ndarray pickle into a .npy file without reading or moving its data
+
+    The raw data of a pickled array is one contiguous run of bytes. The pickle
+    opcodes in front of it are overwritten with an .npy header of exactly the
+    same length and the opcodes after it are cut off, so the data stays where
+    the download wrote it and is ready to be memory-mapped. The data keeps its
+    offset inside the pickle, which is generally not a multiple of the item
+    size, so the mapped array is unaligned (``flags.aligned`` is False). NumPy
+    reads it correctly, through slower unaligned loops. Only protocol 3 and 4
+    pickles of C-ordered arrays are recognized. Returns False, leaving
+    pickle_path untouched, for any other layout or when the header does not
+    fit in front of the data.
+    """
+    dtype = np.dtype(dtype)
+    shape = tuple(shape)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    offset = _pickled_array_offset(pickle_path, nbytes)
+    if offset is None or os.path.getsize(pickle_path) < offset + nbytes:
+        return False
+
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape})
+    # Version 1.0 layout: magic, version, little-endian header length, space padded header ending in a newline
+    preamble = np.lib.format.magic(1, 0)
+    padding = offset - len(preamble) - 2 - len(header) - 1
+    if padding < 0 or offset - len(preamble) - 2 > 0xffff:
+        return False
+    header = header.encode('latin1') + b' ' * padding + b'\n'
+
+    with open(pickle_path, 'r+b') as f:
+        f.write(preamble + struct.pack('<H', len(header)) + header)
+        f.truncate(offset + nbytes)
+    os.replace(pickle_path, npy_path)
+    return True
+
+
+def open_dense(npy_path):
+    """Memory-map a dense .npy similarity matrix read-only"""
+    return np.load(npy_path, mmap_mode='r')
+
+
+def load_column(movies_path, column):
+    """One column of the pickled movies table, in row order"""
+    with open(movies_path, 'rb') as f:
+        values = pickle.load(f)[column]
+    return list(values.values()) if isinstance(values, dict) else list(values)
+
+
+def tokenize(text):
+    """Split a tags string into terms of two or more word characters"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def vectorize_tags(tags, max_features=DEFAULT_MAX_FEATURES, weighting='tfidf', vocabulary_rows=None):
+    """Turn tags strings into L2-normalized sparse term vectors in CSR form
+
+    Only the max_features most frequent terms are kept. weighting is either
+    "count" (raw term counts) or "tfidf" (counts times smoothed inverse
+    document frequency). vocabulary_rows, when given, takes the vocabulary
+    and document frequencies from the first vocabulary_rows tags only, so
+    their vectors stay the same whatever tags follow. Returns indptr,
+    indices, data and the vocabulary.
+    """
+    if weighting not in WEIGHTINGS:
+        raise ValueError(f"Unknown weighting {weighting!r}, expected one of {WEIGHTINGS}")
+
+    documents = [Counter(tokenize(text)) for text in tags]
+    counted = len(documents) if vocabulary_rows is None else vocabulary_rows
+    totals = Counter()
+    for terms in documents[:counted]:
+        totals.update(terms)
+    # Most frequent first, ties in alphabetical order so the vocabulary is reproducible
+    ranked = sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:max_features]
+    vocabulary = {term: i for i, term in enumerate(sorted(term for term, _ in ranked))}
+
+    indptr = np.zeros(len(documents) + 1, dtype=np.int64)
+    indices, data = [], []
+    for row, terms in enumerate(documents):
+        kept = sorted((vocabulary[term], count) for term, count in terms.items() if term in vocabulary)
+        indices.extend(term for term, _ in kept)
+        data.extend(count for _, count in kept)
+        indptr[row + 1] = len(indices)
+    indices = np.asarray(indices, dtype=np.int32)
+    data = np.asarray(data, dtype=np.float32)
+
+    if weighting == 'tfidf':
+        frequency = np.bincount(indices[:indptr[counted]], minlength=len(vocabulary))
+        idf = np.log((1 + counted) / (1 + frequency)) + 1
+        data *= idf[indices].astype(np.float32)
+
+    rows = np.repeat(np.arange(len(documents)), np.diff(indptr))
+    norms = np.sqrt(np.bincount(rows, weights=data.astype(np.float64) ** 2, minlength=len(documents)))
+    norms[norms == 0] = 1
+    data /= norms[rows].astype(np.float32)
+    return indptr, indices, data, vocabulary
+
+
+def transpose_csr(indptr, indices, data, n_columns):
+    """Column-wise (CSC) copy of a CSR matrix"""
+    rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int32), np.diff(indptr))
+    order = np.argsort(indices, kind='stable')
+    column_indptr = np.zeros(n_columns + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=n_columns), out=column_indptr[1:])
+    return column_indptr, rows[order], data[order]
+
+
+def _sparse_matmul(indptr, indices, data, dense, chunk_rows=1024):
+    """Product of a CSR matrix with a dense matrix, gathered a chunk of rows at a time"""
+    n = len(indptr) - 1
+    result = np.zeros((n, dense.shape[1]), dtype=np.float32)
+    for start in range(0, n, chunk_rows):
+        end = min(start + chunk_rows, n)
+        low, high = indptr[start], indptr[end]
+        if low == high:
+            continue
+        products = data[low:high, None] * dense[indices[low:high]]
+        nonempty = np.diff(indptr[start:end + 1]) > 0
+        result[start:end][nonempty] = np.add.reduceat(products, indptr[start:end][nonempty] - low, axis=0)
+    return result
+
+
+def build_embeddings(tags, dim=DEFAULT_EMBEDDING_DIM, max_features=DEFAULT_MAX_FEATURES, weighting='tfidf',
+                     oversample=10, iterations=4, seed=0):
+    """Project the tag vectors onto their top dim singular directions
+
+    Uses a randomized truncated SVD driven only by sparse products with the
+    tag matrix, so the dense n x vocabulary matrix is never built. Rows are
+    L2-normalized, so the dot product of two embeddings is their cosine.
+    """
+    indptr, indices, data, vocabulary = vectorize_tags(tags, max_features, weighting)
+    columns = transpose_csr(indptr, indices, data, len(vocabulary))
+    dim = min(dim, len(vocabulary), len(indptr) - 1)
+    rng = np.random.default_rng(seed)
+
+    sample = rng.standard_normal((len(vocabulary), dim + oversample)).astype(np.float32)
+    basis, _ = np.linalg.qr(_sparse_matmul(indptr, indices, data, sample))
+    # Power iterations sharpen the basis towards the leading singular vectors
+    for _ in range(iterations):
+        projected, _ = np.linalg.qr(_sparse_matmul(*columns, basis))
+        basis, _ = np.linalg.qr(_sparse_matmul(indptr, indices, data, projected))
+
+    small = _sparse_matmul(*columns, basis).T
+    left, singular, _ = np.linalg.svd(small, full_matrices=False)
+    embeddings = (basis @ left[:, :dim]) * singular[:dim]
+
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (embeddings / norms).astype(np.float32)
+
+
+def save_embeddings(path, embeddings):
+    """Write movie embeddings to a .npy file"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(embeddings, dtype=np.float32))
+    os.replace(tmp_path, path)
+
+
+def open_embeddings(path):
+    """Memory-map movie embeddings written by save_embeddings"""
+    return EmbeddingSimilarity(np.load(path, mmap_mode='r'))
+
+
+def build_top_k(similarity, k=DEFAULT_TOP_K, block_size=1024):
+    """Compute the k most similar movies of every row, excluding the movie itself"""
+    n = similarity.shape[0]
+    k = min(k, n - 1)
+    indices = np.empty((n, k), dtype=np.int32)
+    scores = np.empty((n, k), dtype=np.float16)
+
+    # Work in row blocks so a memory-mapped matrix is never fully paged in at once
+    for start in range(0, n, block_size):
+        block = np.array(similarity[start:start + block_size], dtype=np.float64)
+        indices[start:start + len(block)], scores[start:start + len(block)] = _top_k_of_block(block, start, k)
+
+    return indices, scores
+
+
+def _top_k_of_block(block, start, k):
+    """Top k columns of every row of a block of rows beginning at movie start"""
+    rows = np.arange(len(block))
+    block[rows, rows + start] = -np.inf
+
+    top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(block, top, axis=1)
+    # The partition picks arbitrarily among scores tied with the k-th best, those rows
+    # take the lowest movie indices of the tie instead
+    kth = top_scores.min(axis=1, keepdims=True)
+    for row in np.nonzero(np.count_nonzero(block >= kth, axis=1) > k)[0]:
+        candidates = np.nonzero(block[row] >= kth[row])[0]
+        top[row] = candidates[np.lexsort((candidates, -block[row, candidates]))[:k]]
+        top_scores[row] = block[row, top[row]]
+
+    # Highest score first, ties broken by the lower movie index
+    order = np.lexsort((top, -top_scores), axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+# Tag vectors attached by a builder worker process
+_build_engine = None
+
+
+def _init_build_worker(segment_name):
+    global _build_engine
+    _segments[segment_name] = _attach_segment(segment_name, timeout=60)
+    _, arrays = _read_segment(_segments[segment_name])
+    _build_engine = TagSimilarity(**arrays)
+
+
+def _build_block(start, end, k):
+    block = np.empty((end - start, len(_build_engine)), dtype=np.float32)
+    for row in range(start, end):
+        block[row - start] = _build_engine.row(row)
+    indices, scores = _top_k_of_block(block, start, k)
+    return start, indices, scores
+
+
+def build_top_k_from_tags(tags, k=DEFAULT_TOP_K, block_size=256, workers=None,
+                          max_features=DEFAULT_MAX_FEATURES, weighting='tfidf', progress=None):
+    """Top-K neighbor table of tag cosine similarity, computed in row blocks across processes
+
+    The sparse tag vectors are placed in shared memory once and every worker
+    scores block_size rows at a time, so peak memory per worker is the
+    block_size x n score block instead of the n x n matrix.
+    """
+    engine = TagSimilarity.from_tags(tags, max_features, weighting)
+    n = len(engine)
+    k = min(k, n - 1)
+    indices = np.empty((n, k), dtype=np.int32)
+    scores = np.empty((n, k), dtype=np.float16)
+
+    # Segments outlive a killed build and process ids repeat, so every build gets a fresh name
+    segment_name = f"similarity-build-{uuid.uuid4().hex[:12]}"
+    segment = _create_segment(segment_name, {}, engine.arrays())
+    if segment is None:
+        raise FileExistsError(f"Shared memory segment {segment_name!r} already exists")
+    del engine
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_build_worker,
+                                 initargs=(segment_name,)) as pool:
+            futures = [pool.submit(_build_block, start, min(start + block_size, n), k)
+                       for start in range(0, n, block_size)]
+            for done, future in enumerate(as_completed(futures), 1):
+                start, block_indices, block_scores = future.result()
+                indices[start:start + len(block_indices)] = block_indices
+                scores[start:start + len(block_scores)] = block_scores
+                if progress:
+                    progress(done, len(futures))
+    finally:
+        segment.close()
+        _unlink_segment(segment)
+
+    return indices, scores
+
+
+def save_top_k(path, indices, scores):
+    """Write a top-K neighbor table to a .npz file"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, indices=indices, scores=scores)
+    os.replace(tmp_path, path)
+
+
+def open_top_k(path):
+    """Load a top-K neighbor table written by save_top_k"""
+    with np.load(path) as data:
+        indices, scores = data['indices'], data['scores']
+    # The table is shared by every session of the process, nothing may modify it
+    indices.setflags(write=False)
+    scores.setflags(write=False)
+    return TopKSimilarity(indices, scores)
+
+
+def delta_path(path):
+    """Sidecar holding the movies appended to a top-K table after it was built"""
+    root, extension = os.path.splitext(path)
+    if extension in COMPRESSORS:
+        root = os.path.splitext(root)[0]
+    return root + '.delta.npz'
+
+
+def update_top_k(current, tags, max_features=DEFAULT_MAX_FEATURES, weighting='count', block_size=256,
+                 vocabulary_rows=None):
+    """Extend a top-K table with the movies appended to tags after its last row
+
+    Only the rows of the new movies are scored, O(new x n) instead of the
+    O(n^2) of a full build. Since similarity is symmetric, the same rows tell
+    which existing movies gain a new movie among their K nearest neighbors,
+    and only those lists are merged. Returns the indices and scores of the
+    whole extended table.
+    The vocabulary and document frequencies are those of the first
+    vocabulary_rows movies (by default the rows of current), the ones the
+    table was built with, so the scores stored for existing movies stay
+    comparable with the new ones. Terms only the new movies use are left
+    out; the result equals a full build of all tags under that vocabulary,
+    not a full build with a vocabulary recomputed over every movie.
+    """
+    first_new, n = len(current), len(tags)
+    k = current.indices.shape[1]
+    indices = np.concatenate([current.indices, np.empty((n - first_new, k), dtype=np.int32)])
+    scores = np.concatenate([current.scores, np.empty((n - first_new, k), dtype=np.float16)])
+
+    engine = TagSimilarity.from_tags(tags, max_features, weighting,
+                                     first_new if vocabulary_rows is None else vocabulary_rows)
+    weakest = current.scores[:, -1].astype(np.float64)
+    old_rows, new_rows, values = [], [], []
+    for start in range(first_new, n, block_size):
+        block = np.empty((min(block_size, n - start), n), dtype=np.float64)
+        for row in range(len(block)):
+            block[row] = engine.row(start + row)
+        # A new movie enters the list of an existing one only if it beats its weakest neighbor
+        entering, existing = np.nonzero(block[:, :first_new] > weakest)
+        old_rows.append(existing)
+        new_rows.append(entering + start)
+        values.append(block[entering, existing])
+        indices[start:start + len(block)], scores[start:start + len(block)] = _top_k_of_block(block, start, k)
+
+    old_rows, new_rows, values = np.concatenate(old_rows), np.concatenate(new_rows), np.concatenate(values)
+    order = np.argsort(old_rows, kind='stable')
+    rows, starts = np.unique(old_rows[order], return_index=True)
+    for row, group in zip(rows, np.split(order, starts[1:])):
+        merged_indices = np.concatenate([indices[row], new_rows[group]])
+        # Highest score first, ties broken by the lower movie index. Compared at the float16 precision
+        # the existing scores are stored with, so scores that round to the same value may be ordered
+        # differently than by a full build
+        merged_scores = np.concatenate([scores[row], values[group].astype(np.float16)])
+        keep = np.lexsort((merged_indices, -merged_scores))[:k]
+        indices[row], scores[row] = merged_indices[keep], merged_scores[keep]
+
+    return indices, scores
+
+
+def save_top_k_delta(path, base, indices, scores):
+    """Write the rows of an extended top-K table that differ from base, returning how many were patched"""
+    base_rows = len(base)
+    changed = np.nonzero((indices[:base_rows] != base.indices).any(axis=1)
+                         | (scores[:base_rows] != base.scores).any(axis=1))[0].astype(np.int32)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, rows=changed, row_indices=indices[changed], row_scores=scores[changed],
+                 indices=indices[base_rows:], scores=scores[base_rows:])
+    os.replace(tmp_path, path)
+    return len(changed)
+
+
+def open_top_k_delta(path):
+    """Load the arrays written by save_top_k_delta"""
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def apply_top_k_delta(base, delta):
+    """Top-K table of base with the appended rows and patched neighbor lists of a delta"""
+    if delta['indices'].shape[1] != base.indices.shape[1]:
+        raise ValueError(f"Delta keeps {delta['indices'].shape[1]} neighbors per movie, "
+                         f"the base table {base.indices.shape[1]}")
+    indices = np.concatenate([base.indices, delta['indices']])
+    scores = np.concatenate([base.scores, delta['scores']])
+    indices[delta['rows']] = delta['row_indices']
+    scores[delta['rows']] = delta['row_scores']
+    indices.setflags(write=False)
+    scores.setflags(write=False)
+    return TopKSimilarity(indices, scores)
+
+
+def check_top_k_delta(path, movie_ids_sha256):
+    """Raise ValueError unless path holds a current delta for these movies, returning the base movie hash"""
+    return check_artifact_manifest(path, 'topk-delta', movie_ids_sha256)['base_movie_ids_sha256']
+
+
+def append_movies(movies_path, topk_path, new_movies, max_features=None, weighting=None, block_size=256):
+    """Append movies to movies.pkl and record their neighbors in a delta over a top-K table
+
+    new_movies is a list of dicts with a value for every column of
+    movies.pkl (movie_id, title and tags). Movies appended by earlier calls
+    are kept, the delta always holds every change since the base table was
+    built. Tags are vectorized like the base table if it was built from
+    them, otherwise with raw term counts, and always with the vocabulary of
+    the base movies (see update_top_k). Returns the number of rows added
+    and the number of existing rows whose neighbors changed.
+    """
+    if not new_movies:
+        raise ValueError("No movies to append")
+    with open(movies_path, 'rb') as f:
+        table = pickle.load(f)
+    movie_ids = list(table['movie_id'].values())
+    known = set(movie_ids)
+    for movie in new_movies:
+        missing = [column for column in table if column not in movie]
+        if missing:
+            raise ValueError(f"Movie {movie.get('title')!r} has no {', '.join(missing)}")
+        if movie['movie_id'] in known:
+            raise ValueError(f"Movie id {movie['movie_id']} is already in {movies_path}")
+        known.add(movie['movie_id'])
+
+    # The delta on disk, if any, must belong to the current movies and the base to the movies it started from
+    delta = delta_path(topk_path)
+    base_sha256 = movie_ids_digest(movie_ids)
+    if os.path.exists(delta):
+        base_sha256 = check_top_k_delta(delta, base_sha256)
+    build = check_artifact_manifest(topk_path, 'topk', base_sha256)['build']
+    if build.get('source') == 'tags':
+        max_features = max_features or build.get('max_features')
+        weighting = weighting or build.get('weighting')
+    max_features = max_features or DEFAULT_MAX_FEATURES
+    weighting = weighting or 'count'
+
+    base = open_artifact(topk_path, 'topk')
+    current = apply_top_k_delta(base, open_top_k_delta(delta)) if os.path.exists(delta) else base
+
+    label = max(table['movie_id'].keys()) + 1
+    for offset, movie in enumerate(new_movies):
+        for column in table:
+            table[column][label + offset] = movie[column]
+    movie_ids = list(table['movie_id'].values())
+
+    # Vectorized with the vocabulary of the movies the base table was built from
+    indices, scores = update_top_k(current, list(table['tags'].values()), max_features, weighting, block_size,
+                                   vocabulary_rows=len(base))
+    patched = save_top_k_delta(delta, base, indices, scores)
+    manifest = {
+        'format': 'topk-delta',
+        'format_version': FORMAT_VERSION,
+        'rows': len(movie_ids),
+        'movie_ids_sha256': movie_ids_digest(movie_ids),
+        'base_rows': len(base),
+        'base_movie_ids_sha256': base_sha256,
+        'arrays': {name: {'shape': list(array.shape), 'dtype': array.dtype.str}
+                   for name, array in open_top_k_delta(delta).items()},
+        'build': {'source': 'tags', 'max_features': max_features, 'weighting': weighting},
+    }
+    _dump_manifest(manifest, manifest_path(delta))
+
+    # movies.pkl is replaced last and atomically, the app never sees new movies without their rows
+    tmp_path = movies_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(table, f)
+    os.replace(tmp_path, movies_path)
+    return len(new_movies), patched
+
+
+def build_sparse(similarity, min_score=0.0, max_nnz=DEFAULT_MAX_NNZ, block_size=1024):
+    """Keep only the scores above min_score, at most max_nnz per row, in CSR form
+
+    The entries of every row are ordered from most to least similar (ties by
+    movie index) so neighbors() is answered with a slice. Scores keep the
+    dtype of the source matrix. max_nnz of None or 0 keeps every entry above
+    the threshold.
+    """
+    n = similarity.shape[0]
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indices, data = [], []
+
+    for start in range(0, n, block_size):
+        block = np.array(similarity[start:start + block_size])
+        rows = np.arange(len(block))
+        block[rows, rows + start] = -np.inf
+
+        for row in rows:
+            columns = np.flatnonzero(block[row] > min_score)
+            values = block[row, columns]
+            if max_nnz and len(columns) > max_nnz:
+                kept = np.argpartition(-values, max_nnz - 1)[:max_nnz]
+                columns, values = columns[kept], values[kept]
+            order = np.lexsort((columns, -values))
+            indices.append(columns[order].astype(np.int32))
+            data.append(values[order])
+            indptr[start + row + 1] = indptr[start + row] + len(columns)
+
+    return indptr, np.concatenate(indices), np.concatenate(data)
+
+
+def save_sparse(path, indptr, indices, data):
+    """Write a CSR similarity matrix to a .npz file"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, indptr=indptr, indices=indices, data=data)
+    os.replace(tmp_path, path)
+
+
+def open_sparse(path):
+    """Load a CSR similarity matrix written by save_sparse"""
+    with np.load(path) as data:
+        arrays = {key: data[key] for key in ('indptr', 'indices', 'data')}
+    for array in arrays.values():
+        array.setflags(write=False)
+    return SparseSimilarity(**arrays)
+
+
+def save_sharded(directory, similarity, rows_per_shard=DEFAULT_SHARD_ROWS):
+    """Split a dense matrix into .npy files of rows_per_shard rows plus an index.json"""
+    n = similarity.shape[0]
+    tmp_directory = directory + '.tmp'
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    os.makedirs(tmp_directory)
+
+    shards = []
+    for start in range(0, n, rows_per_shard):
+        name = f"shard_{len(shards):05d}.npy"
+        with open(os.path.join(tmp_directory, name), 'wb') as f:
+            np.save(f, np.ascontiguousarray(similarity[start:start + rows_per_shard]))
+        shards.append(name)
+
+    index = {
+        'rows': n,
+        'columns': similarity.shape[1],
+        'rows_per_shard': rows_per_shard,
+        'dtype': np.dtype(similarity.dtype).str,
+        'shards': shards,
+    }
+    _dump_manifest(index, os.path.join(tmp_directory, 'index.json'))
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.replace(tmp_directory, directory)
+    return len(shards)
+
+
+def open_sharded(directory, cache_size=DEFAULT_SHARD_CACHE):
+    """Open a sharded matrix written by save_sharded, only its index is read"""
+    return ShardedSimilarity(directory, load_manifest(os.path.join(directory, 'index.json')), cache_size)
+
+
+def save_compressed(path, engine):
+    """Write the arrays of an engine as one lzma (.xz) or zlib (.gz) compressed stream
+
+    The stream is a JSON header line naming the engine and its arrays,
+    followed by one .npy record per array.
+    """
+    compressor = COMPRESSORS[os.path.splitext(path)[1]]
+    arrays = engine.arrays()
+    header = {'engine': type(engine).__name__, 'arrays': list(arrays)}
+
+    tmp_path = path + '.tmp'
+    with compressor(tmp_path, 'wb') as f:
+        f.write(json.dumps(header).encode() + b'\n')
+        for array in arrays.values():
+            np.lib.format.write_array(f, np.ascontiguousarray(array), allow_pickle=False)
+    os.replace(tmp_path, path)
+
+
+def open_compressed(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Load an engine written by save_compressed
+
+    Every array is allocated up front from its .npy header and filled
+    from the decompressor in slices of at most chunk_size bytes, so the
+    decompressed payload only passes through one bounded buffer at a time
+    and never exists as a whole separate bytes object.
+    """
+    compressor = COMPRESSORS[os.path.splitext(path)[1]]
+    arrays = {}
+    with compressor(path, 'rb') as f:
+        header = json.loads(f.readline())
+        for name in header['arrays']:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+
+            array = np.empty(shape, dtype=dtype)
+            buffer = memoryview(array.reshape(-1).view(np.uint8))
+            filled = 0
+            while filled < len(buffer):
+                # The file objects read the requested length into a fresh bytes object before copying
+                count = f.readinto(buffer[filled:filled + chunk_size])
+                if not count:
+                    raise ValueError(f"{path} ended before array {name!r} was complete")
+                filled += count
+            array.setflags(write=False)
+            arrays[name] = array
+
+    return ENGINES[header['engine']](**arrays)
+
+
+def _scale_path(path):
+    """Sidecar file holding the per-row scale and offset of a uint8 matrix"""
+    return os.path.splitext(path)[0] + '.scale.npy'
+
+
+def save_quantized(path, similarity, precision, block_size=1024):
+    """Write a float16 or per-row scaled uint8 copy of a dense similarity matrix"""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+
+    n = similarity.shape[0]
+    tmp_path = path + '.tmp'
+    codes = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=precision, shape=similarity.shape)
+    scale = np.empty((n, 2), dtype=np.float32)
+
+    for start in range(0, n, block_size):
+        block = np.asarray(similarity[start:start + block_size], dtype=np.float64)
+        if precision == 'float16':
+            codes[start:start + len(block)] = block
+            continue
+
+        # Map every row onto 0..255 between its own minimum and maximum
+        low = block.min(axis=1, keepdims=True)
+        step = (block.max(axis=1, keepdims=True) - low) / 255
+        step[step == 0] = 1
+        codes[start:start + len(block)] = np.rint((block - low) / step)
+        scale[start:start + len(block)] = np.hstack([step, low])
+
+    codes.flush()
+    del codes
+    os.replace(tmp_path, path)
+    if precision == 'uint8':
+        np.save(_scale_path(path), scale)
+
+
+def open_quantized(path):
+    """Memory-map a matrix written by save_quantized"""
+    codes = np.load(path, mmap_mode='r')
+    if codes.dtype == np.uint8:
+        return QuantizedSimilarity(codes, np.load(_scale_path(path)))
+    return QuantizedSimilarity(codes)
+
+
+def save_packed(path, similarity, block_size=1024):
+    """Write the upper triangle of a symmetric similarity matrix, diagonal included, row after row"""
+    n = similarity.shape[0]
+    offsets = _packed_offsets(n)
+    tmp_path = path + '.tmp'
+    packed = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=similarity.dtype, shape=(int(offsets[-1]),))
+
+    for start in range(0, n, block_size):
+        block = np.asarray(similarity[start:start + block_size])
+        for row in range(len(block)):
+            index = start + row
+            packed[offsets[index]:offsets[index + 1]] = block[row, index:]
+
+    packed.flush()
+    del packed
+    os.replace(tmp_path, path)
+
+
+def open_packed(path):
+    """Memory-map a triangle written by save_packed"""
+    return PackedSimilarity(np.load(path, mmap_mode='r'))
+
+
+def _packed_offsets(n):
+    """Start of every row of a packed n x n upper triangle, followed by its total length"""
+    rows = np.arange(n + 1, dtype=np.int64)
+    return rows * n - rows * (rows - 1) // 2
+
+
+def _rankdata(values):
+    """Ranks of values with ties sharing their average rank"""
+    order = np.argsort(values, kind='stable')
+    ranks = np.empty(len(values), dtype=np.float64)
+    ranks[order] = np.arange(len(values))
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    sums = np.bincount(inverse, weights=ranks)
+    return sums[inverse] / counts[inverse]
+
+
+def compare_similarity(reference, candidate, rows=500, seed=0):
+    """Measure how well candidate reproduces the neighbor ranking of reference
+
+    Returns the mean top-5 and top-20 neighbor overlap and the mean Spearman
+    rank correlation of the candidate scores over the reference top-20. A
+    candidate without full rows, like a top-K table, is scored by the
+    neighbors it returns, movies missing from them ranking last.
+    """
+    n = len(reference)
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(n, size=min(rows, n), replace=False)
+
+    overlap_5, overlap_20, correlations = [], [], []
+    for index in sample:
+        expected = [i for i, _ in reference.neighbors(index, 20)]
+        actual = [i for i, _ in candidate.neighbors(index, 20)]
+        overlap_5.append(len(set(expected[:5]) & set(actual[:5])) / 5)
+        overlap_20.append(len(set(expected) & set(actual)) / 20)
+
+        expected_ranks = _rankdata(np.asarray(reference.row(index)[expected], dtype=np.float64))
+        if hasattr(candidate, 'row'):
+            actual_scores = np.asarray(candidate.row(index)[expected], dtype=np.float64)
+        else:
+            kept = dict(candidate.neighbors(index, n - 1))
+            actual_scores = np.array([kept.get(i, -np.inf) for i in expected], dtype=np.float64)
+        actual_ranks = _rankdata(actual_scores)
+        if expected_ranks.std() > 0 and actual_ranks.std() > 0:
+            correlations.append(np.corrcoef(expected_ranks, actual_ranks)[0, 1])
+        else:
+            correlations.append(1.0 if np.array_equal(expected_ranks, actual_ranks) else 0.0)
+
+    return {
+        'rows': len(sample),
+        'top5_overlap': float(np.mean(overlap_5)),
+        'top20_overlap': float(np.mean(overlap_20)),
+        'spearman_top20': float(np.mean(correlations)),
+    }
+
+
+class RowSimilarity:
+    """Backend that can produce the full similarity row of any movie"""
+
+    def row(self, index):
+        raise NotImplementedError
+
+    def neighbors(self, index, k):
+        # Partition out the k best in linear time and sort only those, rather than the whole row
+        block = np.array(self.row(index), dtype=np.float64)[np.newaxis]
+        indices, scores = _top_k_of_block(block, index, min(k, len(self) - 1))
+        return list(zip(indices[0].tolist(), scores[0].tolist()))
+
+
+class DenseSimilarity(RowSimilarity):
+    """Full n x n similarity matrix, usually memory-mapped"""
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def arrays(self):
+        return {'matrix': self.matrix}
+
+    def row(self, index):
+        return self.matrix[index]
+
+
+class QuantizedSimilarity(DenseSimilarity):
+    """Dense matrix stored as float16, or as uint8 with a per-row scale and offset"""
+
+    def __init__(self, matrix, scale=None):
+        super().__init__(matrix)
+        self.scale = scale
+
+    def arrays(self):
+        if self.scale is None:
+            return {'matrix': self.matrix}
+        return {'matrix': self.matrix, 'scale': self.scale}
+
+    def row(self, index):
+        if self.scale is None:
+            return self.matrix[index].astype(np.float32)
+        step, low = self.scale[index]
+        return self.matrix[index] * step + low
+
+
+class PackedSimilarity(RowSimilarity):
+    """Symmetric matrix stored as its upper triangle, half the size of the dense matrix
+
+    Entry (i, j) with i <= j sits at offsets[i] + j - i. Row i is the tail of
+    its own packed row for j >= i, and column i of the rows above it for
+    j < i, both gathered with one vectorized index.
+    """
+
+    def __init__(self, packed):
+        self.packed = packed
+        self.n = int((np.sqrt(8 * len(packed) + 1) - 1) // 2)
+        self.offsets = _packed_offsets(self.n)
+        if self.offsets[-1] != len(packed):
+            raise ValueError(f"{len(packed)} values do not form a packed triangle")
+
+    def __len__(self):
+        return self.n
+
+    def arrays(self):
+        return {'packed': self.packed}
+
+    def row(self, index):
+        above = np.arange(index)
+        positions = np.concatenate([self.offsets[above] + (index - above),
+                                    np.arange(self.offsets[index], self.offsets[index + 1])])
+        return self.packed[positions]
+
+
+class ShardedSimilarity(RowSimilarity):
+    """Dense matrix split into row shards that are memory-mapped on first use
+
+    At most cache_size shards are mapped at a time, the least recently used
+    one is dropped when another is needed. Streamlit serves sessions from
+    several threads, so the cache is guarded by a lock.
+    """
+
+    def __init__(self, directory, index, cache_size=DEFAULT_SHARD_CACHE):
+        self.directory = directory
+        self.index = index
+        self.rows_per_shard = index['rows_per_shard']
+        self.dtype = np.dtype(index['dtype'])
+        self.cache_size = cache_size
+        self._shards = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.index['rows']
+
+    def arrays(self):
+        raise TypeError("sharded similarity is mapped lazily and cannot be placed in shared memory")
+
+    def _shard(self, number):
+        with self._lock:
+            if number in self._shards:
+                self._shards.move_to_end(number)
+                return self._shards[number]
+            shard = np.load(os.path.join(self.directory, self.index['shards'][number]), mmap_mode='r')
+            self._shards[number] = shard
+            if len(self._shards) > self.cache_size:
+                self._shards.popitem(last=False)
+            return shard
+
+    def row(self, index):
+        number, offset = divmod(index, self.rows_per_shard)
+        return self._shard(number)[offset]
+
+
+class SparseSimilarity(RowSimilarity):
+    """Thresholded similarity matrix in CSR form, rows sorted by score"""
+
+    def __init__(self, indptr, indices, data):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def arrays(self):
+        return {'indptr': self.indptr, 'indices': self.indices, 'data': self.data}
+
+    def row(self, index):
+        start, end = self.indptr[index], self.indptr[index + 1]
+        distances = np.zeros(len(self), dtype=self.data.dtype)
+        distances[self.indices[start:end]] = self.data[start:end]
+        return distances
+
+    def neighbors(self, index, k):
+        start = self.indptr[index]
+        end = min(self.indptr[index + 1], start + k)
+        return list(zip(self.indices[start:end].tolist(), self.data[start:end].astype(float).tolist()))
+
+
+class EmbeddingSimilarity(RowSimilarity):
+    """Cosine similarity of low-rank movie embeddings, one matrix-vector product per row"""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    def arrays(self):
+        return {'embeddings': self.embeddings}
+
+    def row(self, index):
+        return self.embeddings @ self.embeddings[index]
+
+
+class TopKSimilarity:
+    """Precomputed table of the K nearest neighbors of every movie"""
+
+    def __init__(self, indices, scores):
+        self.indices = indices
+        self.scores = scores
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def arrays(self):
+        return {'indices': self.indices, 'scores': self.scores}
+
+    def neighbors(self, index, k):
+        return list(zip(self.indices[index, :k].tolist(), self.scores[index, :k].astype(float).tolist()))
+
+
+class TagSimilarity(RowSimilarity):
+    """Cosine similarity computed on demand from sparse tag vectors
+
+    The normalized tag vectors are kept both row-wise (CSR) and column-wise
+    (CSC). A row of the similarity matrix is the product of the column-wise
+    matrix with the sparse vector of the queried movie, so only the movies
+    sharing a term with it are touched and no n x n matrix ever exists.
+    """
+
+    def __init__(self, indptr, indices, data, column_indptr, column_indices, column_data):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.column_indptr = column_indptr
+        self.column_indices = column_indices
+        self.column_data = column_data
+
+    @classmethod
+    def from_tags(cls, tags, max_features=DEFAULT_MAX_FEATURES, weighting='tfidf', vocabulary_rows=None):
+        indptr, indices, data, vocabulary = vectorize_tags(tags, max_features, weighting, vocabulary_rows)
+        column_indptr, column_indices, column_data = transpose_csr(indptr, indices, data, len(vocabulary))
+        return cls(indptr, indices, data, column_indptr, column_indices, column_data)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def arrays(self):
+        return {
+            'indptr': self.indptr, 'indices': self.indices, 'data': self.data,
+            'column_indptr': self.column_indptr, 'column_indices': self.column_indices,
+            'column_data': self.column_data,
+        }
+
+    def row(self, index):
+        start, end = self.indptr[index], self.indptr[index + 1]
+        terms, weights = self.indices[start:end], self.data[start:end]
+
+        # Gather the posting lists of the query terms into one flat run of positions
+        starts = self.column_indptr[terms]
+        lengths = self.column_indptr[terms + 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum()) - np.repeat(offsets - starts, lengths)
+
+        products = self.column_data[positions] * np.repeat(weights, lengths)
+        return np.bincount(self.column_indices[positions], weights=products, minlength=len(self))
+
+
+ENGINES = {cls.__name__: cls for cls in (DenseSimilarity, QuantizedSimilarity, PackedSimilarity,
+                                         SparseSimilarity, EmbeddingSimilarity, TopKSimilarity, TagSimilarity)}
+
+# Segments attached by this process, kept referenced so their buffers stay mapped
+_segments = {}
+
+_ALIGNMENT = 64
+_PREAMBLE = 16
+
+
+def _open_segment(name, create=False, size=0):
+    """Open a shared memory segment that outlives the processes using it"""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    segment = shared_memory.SharedMemory(name=name, create=create, size=size)
+    # Before 3.13 the resource tracker unlinks the segment when any attached process exits
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+def _unlink_segment(segment):
+    """Remove a segment opened with _open_segment"""
+    if sys.version_info < (3, 13):
+        # unlink() also unregisters the segment, balance the unregister done when it was opened
+        resource_tracker.register(segment._name, 'shared_memory')
+    segment.unlink()
+
+
+def _create_segment(name, meta, arrays):
+    """Create and populate a segment, returning None if another process created it first"""
+    layout = {}
+    offset = 0
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[key] = array
+        layout[key] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+
+    header = json.dumps({'meta': meta, 'arrays': layout}).encode()
+    data_start = -(-(_PREAMBLE + len(header)) // _ALIGNMENT) * _ALIGNMENT
+
+    try:
+        segment = _open_segment(name, create=True, size=max(data_start + offset, 1))
+    except FileExistsError:
+        return None
+
+    for key, array in arrays.items():
+        start = data_start + layout[key]['offset']
+        segment.buf[start:start + array.nbytes] = array.reshape(-1).view(np.uint8)
+    segment.buf[_PREAMBLE:_PREAMBLE + len(header)] = header
+    np.ndarray(2, dtype=np.uint64, buffer=segment.buf)[1] = len(header)
+    # Flag the segment as ready last, attaching processes wait for it
+    np.ndarray(2, dtype=np.uint64, buffer=segment.buf)[0] = 1
+    return segment
+
+
+def _attach_segment(name, timeout):
+    """Attach to an existing segment once its creator has finished populating it"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            segment = _open_segment(name)
+            if np.ndarray(2, dtype=np.uint64, buffer=segment.buf)[0] == 1:
+                return segment
+            segment.close()
+        except ValueError:
+            # The creator has not sized the segment yet
+            pass
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Shared memory segment {name!r} was not populated within {timeout}s")
+        time.sleep(0.05)
+
+
+def share_arrays(name, build, timeout=60, replaces=None):
+    """Return arrays held in the named shared memory segment, creating it if needed
+
+    build() returns a ``(meta, arrays)`` pair and is only called when no other
+    process has created the segment yet, so attaching workers never load the
+    source files themselves. Creation is serialized by a lock file, processes
+    arriving meanwhile wait for the creator and attach. A segment left
+    unpopulated by a creator that died is removed and created again. The
+    returned arrays are read-only views.
+    replaces, when given, is the name prefix shared by every version of the
+    segment; creating a new version unlinks the one created before it.
+    """
+    if name not in _segments:
+        try:
+            segment = _attach_segment(name, timeout=0)
+        except (FileNotFoundError, TimeoutError):
+            with artifact_lock(os.path.join(tempfile.gettempdir(), name)):
+                segment = _attach_or_clear_segment(name, timeout)
+                if segment is None:
+                    meta, arrays = build()
+                    segment = _create_segment(name, meta, dict(arrays))
+                    if segment is None:
+                        segment = _attach_segment(name, timeout)
+                    elif replaces:
+                        _replace_segment(replaces, name)
+        _segments[name] = segment
+
+    return _read_segment(_segments[name])
+
+
+def _replace_segment(prefix, name):
+    """Record name as the current segment of prefix, unlinking the one recorded before"""
+    record = os.path.join(tempfile.gettempdir(), prefix + '.segment')
+    with artifact_lock(record):
+        try:
+            with open(record) as f:
+                previous = f.read().strip()
+        except FileNotFoundError:
+            previous = None
+        if previous and previous != name:
+            # Processes still attached to it keep their mapping until they exit
+            try:
+                unlink_shared(previous)
+            except FileNotFoundError:
+                pass
+        tmp_path = record + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(name)
+        os.replace(tmp_path, record)
+
+
+def _attach_or_clear_segment(name, timeout):
+    """Attach to a populated segment, returning None after unlinking one its creator never finished"""
+    # The creator populates while holding the lock, so an unpopulated segment found by the lock
+    # holder was abandoned. Without file locks a creator may still be at work, it gets the timeout.
+    try:
+        return _attach_segment(name, timeout if fcntl is None else 0)
+    except FileNotFoundError:
+        return None
+    except TimeoutError:
+        try:
+            unlink_shared(name)
+        except FileNotFoundError:
+            pass
+        return None
+
+
+def _read_segment(segment):
+    """Metadata and read-only array views of a populated segment"""
+    header_size = int(np.ndarray(2, dtype=np.uint64, buffer=segment.buf)[1])
+    header = json.loads(bytes(segment.buf[_PREAMBLE:_PREAMBLE + header_size]))
+    data_start = -(-(_PREAMBLE + header_size) // _ALIGNMENT) * _ALIGNMENT
+
+    arrays = {}
+    for key, spec in header['arrays'].items():
+        array = np.ndarray(spec['shape'], dtype=np.dtype(spec['dtype']), buffer=segment.buf,
+                           offset=data_start + spec['offset'])
+        array.setflags(write=False)
+        arrays[key] = array
+    return header['meta'], arrays
+
+
+def share_engine(name, load_engine, timeout=60, replaces=None):
+    """Similarity engine backed by the named shared memory segment"""
+
+    def build():
+        engine = load_engine()
+        return {'engine': type(engine).__name__}, engine.arrays()
+
+    meta, arrays = share_arrays(name, build, timeout, replaces)
+    return ENGINES[meta['engine']](**arrays)
+
+
+def unlink_shared(name):
+    """Remove a shared memory segment, workers that attached keep their mapping"""
+    segment = _open_segment(name)
+    segment.close()
+    _unlink_segment(segment)
+
+
+def _print_report(report):
+    for key, value in report.items():
+        print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage similarity matrix artifacts")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert = subparsers.add_parser('convert', help="convert similarity.pkl to a memory-mappable .npy")
+    convert.add_argument('source', help="pickled similarity matrix")
+    convert.add_argument('destination', help="output .npy file")
+
+    topk = subparsers.add_parser('topk', help="build a top-K neighbor table from a dense .npy matrix")
+    topk.add_argument('source', help="dense .npy similarity matrix")
+    topk.add_argument('destination', help="output .npz file")
+    topk.add_argument('--k', type=int, default=DEFAULT_TOP_K, help="neighbors kept per movie")
+
+    sparse = subparsers.add_parser('sparse', help="build a thresholded CSR matrix from a dense .npy matrix")
+    sparse.add_argument('source', help="dense .npy similarity matrix")
+    sparse.add_argument('destination', help="output .npz file")
+    sparse.add_argument('--min-score', type=float, default=0.0, help="drop scores at or below this value")
+    sparse.add_argument('--max-nnz', type=int, default=DEFAULT_MAX_NNZ, help="entries kept per row, 0 for all")
+
+    build = subparsers.add_parser('build', help="build a top-K neighbor table from the tags of movies.pkl")
+    build.add_argument('source', help="pickled movies table with a tags column")
+    build.add_argument('destination', help="output .npz file")
+    build.add_argument('--k', type=int, default=DEFAULT_TOP_K, help="neighbors kept per movie")
+    build.add_argument('--block-size', type=int, default=256, help="rows scored at once by a worker")
+    build.add_argument('--workers', type=int, default=None, help="worker processes, defaults to the CPU count")
+    build.add_argument('--max-features', type=int, default=DEFAULT_MAX_FEATURES, help="vocabulary size")
+    build.add_argument('--weighting', choices=WEIGHTINGS, default='tfidf')
+
+    append = subparsers.add_parser('append', help="add movies to movies.pkl and a delta over a top-K table")
+    append.add_argument('movies', help="pickled movies table, updated in place")
+    append.add_argument('topk', help="top-K .npz table, its delta is written next to it")
+    append.add_argument('source', help="JSON list of movies with movie_id, title and tags")
+    append.add_argument('--max-features', type=int, default=None, help="vocabulary size, by default the base table's")
+    append.add_argument('--weighting', choices=WEIGHTINGS, default=None, help="by default the base table's, else count")
+
+    compress = subparsers.add_parser('compress', help="pack an artifact into an .xz or .gz stream")
+    compress.add_argument('source', help="artifact to pack")
+    compress.add_argument('destination', help="output file ending in .xz or .gz")
+    compress.add_argument('--kind', required=True, help="artifact format of the source, e.g. topk or uint8")
+
+    shard = subparsers.add_parser('shard', help="split a dense .npy matrix into row shards")
+    shard.add_argument('source', help="dense .npy similarity matrix")
+    shard.add_argument('destination', help="output directory")
+    shard.add_argument('--rows-per-shard', type=int, default=DEFAULT_SHARD_ROWS)
+
+    embed = subparsers.add_parser('embed', help="build low-rank movie embeddings from the tags of movies.pkl")
+    embed.add_argument('source', help="pickled movies table with a tags column")
+    embed.add_argument('destination', help="output .npy file")
+    embed.add_argument('--dim', type=int, default=DEFAULT_EMBEDDING_DIM, help="embedding dimensions")
+    embed.add_argument('--max-features', type=int, default=DEFAULT_MAX_FEATURES, help="vocabulary size")
+    embed.add_argument('--weighting', choices=WEIGHTINGS, default='tfidf')
+    embed.add_argument('--reference', help="dense .npy matrix to report top-K agreement against")
+
+    pack = subparsers.add_parser('pack', help="write the upper triangle of a dense .npy matrix")
+    pack.add_argument('source', help="dense .npy similarity matrix")
+    pack.add_argument('destination', help="output .npy file")
+
+    quantize = subparsers.add_parser('quantize', help="write a float16 or uint8 copy of a dense .npy matrix")
+    quantize.add_argument('source', help="dense .npy similarity matrix")
+    quantize.add_argument('destination', help="output .npy file")
+    quantize.add_argument('--precision', choices=PRECISIONS, default='uint8')
+
+    compare = subparsers.add_parser('compare', help="report neighbor agreement of an artifact with the dense matrix")
+    compare.add_argument('reference', help="float64 .npy similarity matrix")
+    compare.add_argument('candidate', help="artifact to evaluate")
+    compare.add_argument('--kind', default=None, help="artifact format of the candidate, by default a quantized matrix")
+    compare.add_argument('--rows', type=int, default=500, help="number of sampled rows")
+
+    manifest = subparsers.add_parser('manifest', help="record checksum, size and shape of similarity.pkl")
+    manifest.add_argument('source', help="pickled similarity matrix")
+    manifest.add_argument('destination', help="manifest .json file, updated in place")
+    manifest.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help="bytes per hashed block")
+
+    unshare = subparsers.add_parser('unshare', help="remove a shared memory segment left by the app")
+    unshare.add_argument('name', help="segment name")
+
+    for command in (convert, topk, sparse, compress, shard, pack, quantize, manifest):
+        command.add_argument('--movies', default='movies.pkl', help="movies table the artifact belongs to")
+
+    args = parser.parse_args(argv)
+    if args.command in ('build', 'embed'):
+        args.movies = args.source
+
+    if args.command == 'convert':
+        shape = convert_pickle_to_npy(args.source, args.destination)
+        built = ('dense', {'source': os.path.basename(args.source)})
+        print(f"Wrote {args.destination} with shape {shape}")
+    elif args.command == 'topk':
+        indices, scores = build_top_k(open_dense(args.source), k=args.k)
+        save_top_k(args.destination, indices, scores)
+        built = ('topk', {'source': os.path.basename(args.source), 'k': indices.shape[1]})
+        print(f"Wrote {args.destination} with {indices.shape[1]} neighbors per movie")
+    elif args.command == 'sparse':
+        indptr, indices, data = build_sparse(open_dense(args.source), args.min_score, args.max_nnz)
+        save_sparse(args.destination, indptr, indices, data)
+        built = ('sparse', {'source': os.path.basename(args.source), 'min_score': args.min_score,
+                            'max_nnz': args.max_nnz})
+        print(f"Wrote {args.destination} with {len(data)} stored scores")
+    elif args.command == 'build':
+        tags = load_column(args.source, 'tags')
+        indices, scores = build_top_k_from_tags(
+            tags, k=args.k, block_size=args.block_size, workers=args.workers,
+            max_features=args.max_features, weighting=args.weighting,
+            progress=lambda done, total: print(f"\r{done}/{total} blocks", end='', flush=True))
+        print()
+        save_top_k(args.destination, indices, scores)
+        built = ('topk', {'source': 'tags', 'k': indices.shape[1], 'max_features': args.max_features,
+                          'weighting': args.weighting})
+        print(f"Wrote {args.destination} with {indices.shape[1]} neighbors per movie")
+    elif args.command == 'append':
+        with open(args.source) as f:
+            new_movies = json.load(f)
+        with artifact_lock(args.topk):
+            added, patched = append_movies(args.movies, args.topk, new_movies, args.max_features, args.weighting)
+        print(f"Appended {added} movies to {args.movies}, {patched} existing neighbor lists changed")
+    elif args.command == 'compress':
+        save_compressed(args.destination, open_artifact(args.source, args.kind))
+        built = (args.kind, {'source': os.path.basename(args.source)})
+        print(f"Wrote {args.destination} ({os.path.getsize(args.destination)} bytes)")
+    elif args.command == 'shard':
+        count = save_sharded(args.destination, open_dense(args.source), args.rows_per_shard)
+        built = ('sharded', {'source': os.path.basename(args.source), 'rows_per_shard': args.rows_per_shard})
+        print(f"Wrote {count} shards to {args.destination}")
+    elif args.command == 'embed':
+        embeddings = build_embeddings(load_column(args.source, 'tags'), args.dim, args.max_features, args.weighting)
+        save_embeddings(args.destination, embeddings)
+        built = ('embedding', {'source': 'tags', 'dim': embeddings.shape[1], 'max_features': args.max_features,
+                               'weighting': args.weighting})
+        print(f"Wrote {args.destination} with {embeddings.shape[1]} dimensions")
+        if args.reference:
+            _print_report(compare_similarity(DenseSimilarity(open_dense(args.reference)), EmbeddingSimilarity(embeddings)))
+    elif args.command == 'pack':
+        save_packed(args.destination, open_dense(args.source))
+        built = ('packed', {'source': os.path.basename(args.source)})
+        print(f"Wrote {args.destination} ({os.path.getsize(args.destination)} bytes)")
+    elif args.command == 'quantize':
+        save_quantized(args.destination, open_dense(args.source), args.precision)
+        built = (args.precision, {'source': os.path.basename(args.source)})
+        print(f"Wrote {args.destination} as {args.precision}")
+    elif args.command == 'compare':
+        candidate = open_artifact(args.candidate, args.kind) if args.kind else open_quantized(args.candidate)
+        _print_report(compare_similarity(DenseSimilarity(open_dense(args.reference)), candidate, rows=args.rows))
+    elif args.command == 'manifest':
+        written = write_manifest(args.source, args.destination, args.movies, args.chunk_size)
+        print(f"Wrote {args.destination} with sha256 {written['sha256']} and {len(written['chunks'])} chunks")
+    elif args.command == 'unshare':
+        unlink_shared(args.name)
+        print(f"Removed shared memory segment {args.name}")
+
+    if args.command in ('convert', 'topk', 'sparse', 'compress', 'shard', 'build', 'embed', 'pack', 'quantize'):
+        kind, build = built
+        # Artifacts derived from the published pickle carry its checksum, so the app notices when it is replaced
+        if args.command == 'convert':
+            build['sha256'], _ = file_digest(args.source)
+        elif build['source'] != 'tags':
+            upstream = load_manifest(manifest_path(args.source)).get('build', {}).get('sha256')
+            if upstream:
+                build['sha256'] = upstream
+        write_artifact_manifest(args.destination, kind,
+                                movie_ids_digest(load_column(args.movies, 'movie_id')), build)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+import hashlib
+import http.server
+import os
+import re
+import socketserver
+import threading
+
+import pytest
+import requests
+
+import downloads
+
+SIZE = 1_000_000
+RANGE_SIZE = 100_000
+
+
+class RangeServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Local stand-in for a download host, optionally without Range support or dropping a response"""
+
+    daemon_threads = True
+
+    def __init__(self, data):
+        super().__init__(('127.0.0.1', 0), RangeHandler)
+        self.data = data
+        self.ranges = True
+        # Offset of the response to cut off after drop_bytes bytes, once
+        self.drop_at = None
+        self.drop_bytes = 1000
+        self.requests = []
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/similarity.pkl'
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.data
+        header = self.headers.get('Range')
+        self.server.requests.append(header)
+        start, end = 0, len(data) - 1
+        if header and self.server.ranges:
+            match = re.fullmatch(r'bytes=(\d+)-(\d*)', header)
+            start = int(match.group(1))
+            end = min(int(match.group(2)), end) if match.group(2) else end
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        else:
+            self.send_response(200)
+        body = data[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if self.server.drop_at == start and len(body) > 1:
+            self.server.drop_at = None
+            self.wfile.write(body[:self.server.drop_bytes])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def data():
+    return os.urandom(SIZE)
+
+
+@pytest.fixture
+def server(data):
+    server = RangeServer(data)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def destination(tmp_path):
+    return str(tmp_path / 'similarity.pkl')
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def requested_ranges(server):
+    """(start, end) of every range request after the size probe"""
+    ranges = []
+    for header in server.requests:
+        match = re.fullmatch(r'bytes=(\d+)-(\d+)', header or '')
+        if match and header != 'bytes=0-0':
+            ranges.append((int(match.group(1)), int(match.group(2)) + 1))
+    return ranges
+
+
+def test_parallel_ranges_download(server, data, destination):
+    progress = []
+
+    downloads.download_large_file(server.url, destination, expected_sha256=sha256(data), expected_size=SIZE,
+                                  progress=lambda done, total: progress.append((done, total)),
+                                  range_size=RANGE_SIZE)
+
+    assert read(destination) == data
+    assert sorted(requested_ranges(server)) == [(start, start + RANGE_SIZE) for start in range(0, SIZE, RANGE_SIZE)]
+    assert progress[-1] == (SIZE, SIZE)
+    assert not os.path.exists(destination + '.part')
+    assert not os.path.exists(destination + '.part.ranges')
+
+
+def test_dropped_range_is_retried(server, data, destination):
+    server.drop_at = 3 * RANGE_SIZE
+    server.drop_bytes = 60_000
+
+    downloads.download_large_file(server.url, destination, expected_sha256=sha256(data), range_size=RANGE_SIZE)
+
+    assert read(destination) == data
+    # Only that range is asked for again, from the last chunk written
+    retries = [start for start, end in requested_ranges(server) if end == 4 * RANGE_SIZE]
+    assert len(retries) == 2
+    assert 3 * RANGE_SIZE <= max(retries) <= 3 * RANGE_SIZE + server.drop_bytes
+    assert len(requested_ranges(server)) == SIZE // RANGE_SIZE + 1
+
+
+def test_interrupted_ranges_download_resumes(server, data, destination):
+    server.drop_at = 5 * RANGE_SIZE
+    with pytest.raises(requests.RequestException):
+        downloads.download_large_file(server.url, destination, expected_sha256=sha256(data), retries=0,
+                                      workers=2, range_size=RANGE_SIZE)
+
+    assert not os.path.exists(destination)
+    with open(destination + '.part.ranges') as f:
+        finished = [tuple(map(int, line.split())) for line in f]
+    assert (5 * RANGE_SIZE, 6 * RANGE_SIZE) not in finished
+    part = read(destination + '.part')
+    assert len(part) == SIZE
+    for start, end in finished:
+        assert part[start:end] == data[start:end]
+
+    server.requests.clear()
+    downloads.download_large_file(server.url, destination, expected_sha256=sha256(data), range_size=RANGE_SIZE)
+
+    assert read(destination) == data
+    fetched = requested_ranges(server)
+    assert (5 * RANGE_SIZE, 6 * RANGE_SIZE) in fetched
+    assert not set(fetched) & set(finished)
+    assert not os.path.exists(destination + '.part.ranges')
+
+
+def test_ranges_record_skips_finished_ranges(server, data, destination):
+    # Two finished ranges, the second one split across the range grid
+    with open(destination + '.part', 'wb') as f:
+        f.write(data[:150_000] + bytes(SIZE - 150_000))
+        f.seek(420_000)
+        f.write(data[420_000:500_000])
+    with open(destination + '.part.ranges', 'w') as f:
+        f.write("0 150000\n420000 500000\n")
+
+    downloads.download_large_file(server.url, destination, expected_sha256=sha256(data), range_size=RANGE_SIZE)
+
+    assert read(destination) == data
+    assert sorted(requested_ranges(server)) == [(150_000, 250_000), (250_000, 350_000), (350_000, 420_000),
+                                                 (500_000, 600_000), (600_000, 700_000), (700_000, 800_000),
+                                                 (800_000, 900_000), (900_000, 1_000_000)]
+
+
+def test_sequential_part_is_continued_as_ranges(server, data, destination):
+    # A part without a ranges record holds a prefix written by a sequential download
+    with open(destination + '.part', 'wb') as f:
+        f.write(data[:250_000])
+
+    downloads.download_large_file(server.url, destination, expected_sha256=sha256(data), range_size=RANGE_SIZE)
+
+    assert read(destination) == data
+    assert min(start for start, _ in requested_ranges(server)) == 250_000
+
+
+def test_sequential_download_resumes_from_part(server, data, destination):
+    server.drop_at = 0
+    server.drop_bytes = 300_000
+
+    downloads.download_large_file(server.url, destination, expected_sha256=sha256(data), expected_size=SIZE,
+                                  workers=1)
+
+    assert read(destination) == data
+    first, resumed = server.requests
+    assert first is None
+    # The part keeps the whole chunks received before the connection dropped
+    offset = int(re.fullmatch(r'bytes=(\d+)-', resumed).group(1))
+    assert 0 < offset <= server.drop_bytes
+
+
+def test_server_without_ranges_downloads_whole_file(server, data, destination):
+    server.ranges = False
+    # A ranges record cannot be used without Range support, its part is discarded
+    with open(destination + '.part', 'wb') as f:
+        f.write(bytes(SIZE))
+    with open(destination + '.part.ranges', 'w') as f:
+        f.write("0 100000\n")
+
+    downloads.download_large_file(server.url, destination, expected_sha256=sha256(data), expected_size=SIZE)
+
+    assert read(destination) == data
+    assert not os.path.exists(destination + '.part.ranges')
+
+
+def test_checksum_mismatch_discards_download(server, destination):
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        downloads.download_large_file(server.url, destination, expected_sha256='0' * 64, range_size=RANGE_SIZE)
+
+    assert not os.path.exists(destination)
+    assert not os.path.exists(destination + '.part')
+
+
+def test_size_mismatch_fails_before_downloading(server, destination):
+    with pytest.raises(ValueError, match="the server has"):
+        downloads.download_large_file(server.url, destination, expected_size=SIZE + 1)
+
+    assert server.requests == ['bytes=0-0']
+
+
+def test_seeded_download_fetches_changed_chunks_only(server, data, tmp_path, destination):
+    chunk_size = RANGE_SIZE
+    previous = tmp_path / 'similarity.npy'
+    previous.write_bytes(data[:300_000] + os.urandom(100_000) + data[400_000:])
+    manifest = {'size': SIZE, 'chunk_size': chunk_size,
+                'chunks': [sha256(data[start:start + chunk_size]) for start in range(0, SIZE, chunk_size)]}
+
+    assert downloads.seed_download(destination, str(previous), manifest) == 9
+    downloads.download_large_file(server.url, destination, expected_sha256=sha256(data), range_size=RANGE_SIZE)
+
+    assert read(destination) == data
+    assert requested_ranges(server) == [(300_000, 400_000)]
+
+
+@pytest.mark.parametrize('scheme', ['http', 'file', 'path'])
+def test_fetch_from_source(server, data, tmp_path, destination, scheme):
+    local = tmp_path / 'mirror.pkl'
+    local.write_bytes(data)
+    source = {'http': server.url + ';timeout=5', 'file': local.as_uri(), 'path': str(local)}[scheme]
+
+    downloads.fetch_from_source(source, destination, sha256(data), SIZE)
+
+    assert read(destination) == data
+
+
+def test_fetch_from_local_source_checks_checksum(data, tmp_path, destination):
+    local = tmp_path / 'mirror.pkl'
+    local.write_bytes(data)
+
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        downloads.fetch_from_source(str(local), destination, '0' * 64, SIZE)
+    assert not os.path.exists(destination)
+
+
+def test_ranges_are_hashed_without_reading_the_file_back(server, data, destination, monkeypatch):
+    def file_digest(path, chunk_size=1 << 20):
+        raise AssertionError("the assembled file was read again")
+
+    monkeypatch.setattr(downloads.similarity_store, 'file_digest', file_digest)
+
+    downloads.download_large_file(server.url, destination, expected_sha256=sha256(data), range_size=RANGE_SIZE)
+
+    assert read(destination) == data
+
+
+def test_corrupt_finished_range_fails_checksum(server, data, destination):
+    with open(destination + '.part', 'wb') as f:
+        f.write(bytes(SIZE))
+    with open(destination + '.part.ranges', 'w') as f:
+        f.write("200000 300000\n")
+
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        downloads.download_large_file(server.url, destination, expected_sha256=sha256(data), range_size=RANGE_SIZE)
+    assert not os.path.exists(destination)
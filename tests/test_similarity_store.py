@@ -0,0 +1,383 @@
+import glob
+import os
+import pickle
+import tempfile
+import tracemalloc
+import uuid
+
+import numpy as np
+import pytest
+
+import similarity_store
+
+
+def write_pickle(path, array, protocol):
+    with open(path, 'wb') as f:
+        pickle.dump(array, f, protocol=protocol)
+    return path
+
+
+@pytest.fixture
+def matrix():
+    rng = np.random.default_rng(0)
+    return rng.random((40, 40))
+
+
+@pytest.mark.parametrize('protocol', [3, 4])
+def test_pickle_to_npy_in_place_converts(tmp_path, matrix, protocol):
+    pickle_path = write_pickle(tmp_path / 'similarity.pkl', matrix, protocol)
+    npy_path = tmp_path / 'similarity.npy'
+
+    assert similarity_store.pickle_to_npy_in_place(str(pickle_path), str(npy_path), matrix.shape, matrix.dtype)
+
+    assert not pickle_path.exists()
+    mapped = similarity_store.open_dense(str(npy_path))
+    assert mapped.shape == matrix.shape
+    assert mapped.dtype == matrix.dtype
+    np.testing.assert_array_equal(mapped, matrix)
+
+
+@pytest.mark.parametrize('protocol', [3, 4])
+def test_pickle_to_npy_in_place_keeps_data_offset(tmp_path, matrix, protocol):
+    pickle_path = write_pickle(tmp_path / 'similarity.pkl', matrix, protocol)
+    data = matrix.tobytes()
+    offset = pickle_path.read_bytes().index(data)
+    npy_path = tmp_path / 'similarity.npy'
+
+    similarity_store.pickle_to_npy_in_place(str(pickle_path), str(npy_path), matrix.shape, matrix.dtype)
+
+    converted = npy_path.read_bytes()
+    assert len(converted) == offset + len(data)
+    assert converted[offset:] == data
+    mapped = np.load(npy_path, mmap_mode='r')
+    assert mapped.offset == offset
+    assert mapped.flags.aligned == (offset % matrix.dtype.itemsize == 0)
+
+
+@pytest.mark.parametrize('protocol', [2, 5])
+def test_pickle_to_npy_in_place_falls_back(tmp_path, matrix, protocol):
+    pickle_path = write_pickle(tmp_path / 'similarity.pkl', matrix, protocol)
+    original = pickle_path.read_bytes()
+    npy_path = tmp_path / 'similarity.npy'
+
+    assert not similarity_store.pickle_to_npy_in_place(str(pickle_path), str(npy_path), matrix.shape, matrix.dtype)
+
+    assert pickle_path.read_bytes() == original
+    assert not npy_path.exists()
+    similarity_store.convert_pickle_to_npy(str(pickle_path), str(npy_path), matrix.shape, matrix.dtype)
+    np.testing.assert_array_equal(similarity_store.open_dense(str(npy_path)), matrix)
+
+
+def test_pickle_to_npy_in_place_rejects_fortran_order(tmp_path, matrix):
+    fortran = np.asfortranarray(matrix)
+    pickle_path = write_pickle(tmp_path / 'similarity.pkl', fortran, 4)
+    original = pickle_path.read_bytes()
+
+    assert not similarity_store.pickle_to_npy_in_place(str(pickle_path), str(tmp_path / 'similarity.npy'),
+                                                       fortran.shape, fortran.dtype)
+    assert pickle_path.read_bytes() == original
+
+
+def test_pickle_to_npy_in_place_rejects_other_size(tmp_path, matrix):
+    pickle_path = write_pickle(tmp_path / 'similarity.pkl', matrix, 4)
+    original = pickle_path.read_bytes()
+
+    assert not similarity_store.pickle_to_npy_in_place(str(pickle_path), str(tmp_path / 'similarity.npy'),
+                                                       matrix.shape, np.float32)
+    assert pickle_path.read_bytes() == original
+
+
+def test_pickle_to_npy_in_place_rejects_truncated_pickle(tmp_path, matrix):
+    pickle_path = write_pickle(tmp_path / 'similarity.pkl', matrix, 4)
+    truncated = pickle_path.read_bytes()[:-100]
+    pickle_path.write_bytes(truncated)
+
+    assert not similarity_store.pickle_to_npy_in_place(str(pickle_path), str(tmp_path / 'similarity.npy'),
+                                                       matrix.shape, matrix.dtype)
+    assert pickle_path.read_bytes() == truncated
+
+
+@pytest.mark.parametrize('suffix', ['.xz', '.gz'])
+def test_open_compressed_fills_arrays_in_bounded_pieces(tmp_path, suffix):
+    # Compressible, so that writing it stays fast
+    matrix = (np.arange(3 << 20, dtype=np.float64) % 977).reshape(3072, 1024) / 977
+    path = str(tmp_path / ('similarity' + suffix))
+    similarity_store.save_compressed(path, similarity_store.DenseSimilarity(matrix))
+
+    tracemalloc.start()
+    try:
+        engine = similarity_store.open_compressed(path)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    np.testing.assert_array_equal(engine.matrix, matrix)
+    # The array itself plus bounded buffers, the 8 MiB lzma dictionary being the largest
+    assert peak < matrix.nbytes + (12 << 20)
+
+
+def previous_neighbors(row, k):
+    """Neighbor order of the original sort over the whole row, the movie itself ranking first"""
+    return sorted(list(enumerate(row)), reverse=True, key=lambda x: x[1])[1:k + 1]
+
+
+@pytest.fixture
+def tied_matrix():
+    # Scores rounded to one decimal tie a lot, also across the k-th place
+    rng = np.random.default_rng(1)
+    scores = np.round(rng.random((60, 60)), 1) * 0.9
+    matrix = np.triu(scores, 1) + np.triu(scores, 1).T
+    np.fill_diagonal(matrix, 1.0)
+    return matrix
+
+
+@pytest.mark.parametrize('k', [1, 5, 20])
+def test_neighbors_match_previous_sort(tied_matrix, k):
+    engine = similarity_store.DenseSimilarity(tied_matrix)
+
+    for index in range(len(tied_matrix)):
+        assert engine.neighbors(index, k) == previous_neighbors(tied_matrix[index], k)
+
+
+@pytest.mark.parametrize('block_size', [7, 1024])
+def test_build_top_k_matches_previous_sort(tied_matrix, block_size):
+    indices, scores = similarity_store.build_top_k(tied_matrix, k=5, block_size=block_size)
+
+    for index in range(len(tied_matrix)):
+        expected = previous_neighbors(tied_matrix[index], 5)
+        assert indices[index].tolist() == [i for i, _ in expected]
+        np.testing.assert_allclose(scores[index], [s for _, s in expected], rtol=1e-3)
+
+
+def test_neighbors_break_ties_at_the_kth_place_by_movie_index():
+    row = np.array([0.5, 0.9, 1.0, 0.5, 0.9, 0.5, 0.2])
+    matrix = np.tile(row, (7, 1))
+
+    assert similarity_store.DenseSimilarity(matrix).neighbors(2, 3) == [(1, 0.9), (4, 0.9), (0, 0.5)]
+
+
+def test_neighbors_exclude_the_movie_but_not_its_duplicate(tied_matrix):
+    # Movie 7 repeats movie 3, both score 1.0 against each other and themselves
+    matrix = tied_matrix.copy()
+    matrix[7] = matrix[3]
+    matrix[:, 7] = matrix[:, 3]
+    matrix[7, 7] = 1.0
+    engine = similarity_store.DenseSimilarity(matrix)
+
+    for index, duplicate in ((3, 7), (7, 3)):
+        neighbors = engine.neighbors(index, 5)
+        assert neighbors[0] == (duplicate, 1.0)
+        assert index not in [i for i, _ in neighbors]
+    indices, _ = similarity_store.build_top_k(matrix, k=5, block_size=4)
+    assert indices[3, 0] == 7 and indices[7, 0] == 3
+    assert 3 not in indices[3] and 7 not in indices[7]
+
+
+WORDS = ['action', 'alien', 'comedy', 'crime', 'drama', 'family', 'future', 'heist', 'history', 'horror',
+         'island', 'love', 'magic', 'murder', 'music', 'ocean', 'police', 'prison', 'revenge', 'robot',
+         'school', 'space', 'sport', 'spy', 'superhero', 'time', 'war', 'western', 'witch', 'zombie']
+
+
+def random_tags(rng, count, words=WORDS):
+    return [' '.join(rng.choice(words, size=rng.integers(3, 12))) for _ in range(count)]
+
+
+def full_top_k(tags, k, weighting, vocabulary_rows=None):
+    """Top-K table of a full build over every row of the tag similarity"""
+    engine = similarity_store.TagSimilarity.from_tags(tags, 1000, weighting, vocabulary_rows)
+    return similarity_store.build_top_k(np.array([engine.row(i) for i in range(len(engine))]), k=k)
+
+
+def assert_same_top_k(actual, expected):
+    (indices, scores), (expected_indices, expected_scores) = actual, expected
+    np.testing.assert_array_equal(scores, expected_scores)
+    # Movies whose scores round to the same float16 may come in either order, and
+    # those tied with the K-th score may be swapped for another one of them
+    for row in np.nonzero((indices != expected_indices).any(axis=1))[0]:
+        for score in set(scores[row][scores[row] > scores[row, -1]].tolist()):
+            assert set(indices[row][scores[row] == score]) == set(expected_indices[row][scores[row] == score])
+
+
+@pytest.mark.parametrize('block_size', [3, 256])
+def test_update_top_k_matches_full_build_with_the_same_vocabulary(block_size):
+    rng = np.random.default_rng(2)
+    # The new movies only use terms the existing ones already have
+    tags = random_tags(rng, 80) + random_tags(rng, 12, WORDS[:20])
+    base = similarity_store.TopKSimilarity(*full_top_k(tags[:80], 5, 'count'))
+
+    updated = similarity_store.update_top_k(base, tags, 1000, 'count', block_size)
+
+    assert_same_top_k(updated, full_top_k(tags, 5, 'count'))
+
+
+def test_update_top_k_keeps_the_base_vocabulary():
+    rng = np.random.default_rng(3)
+    # New terms, and document frequencies that shift the tf-idf weights of the existing movies
+    tags = random_tags(rng, 60) + random_tags(rng, 10, ['unseen', 'sequel', 'space', 'robot'])
+    base_indices, base_scores = full_top_k(tags[:60], 5, 'tfidf')
+    base = similarity_store.TopKSimilarity(base_indices, base_scores)
+
+    indices, scores = similarity_store.update_top_k(base, tags, 1000, 'tfidf')
+
+    assert_same_top_k((indices, scores), full_top_k(tags, 5, 'tfidf', vocabulary_rows=60))
+    # Existing lists only change where a new movie entered them
+    kept = ~np.isin(indices[:60], np.arange(60, 70)).any(axis=1)
+    np.testing.assert_array_equal(indices[:60][kept], base_indices[kept])
+
+
+def test_append_movies_writes_a_delta_over_the_base_table(tmp_path):
+    rng = np.random.default_rng(4)
+    tags = random_tags(rng, 50)
+    movies_path, topk_path = str(tmp_path / 'movies.pkl'), str(tmp_path / 'similarity_topk.npz')
+    table = {'movie_id': dict(enumerate(range(100, 150))), 'title': {i: f"Movie {i}" for i in range(50)},
+             'tags': dict(enumerate(tags))}
+    with open(movies_path, 'wb') as f:
+        pickle.dump(table, f)
+    similarity_store.save_top_k(topk_path, *full_top_k(tags, 5, 'count'))
+    similarity_store.write_artifact_manifest(topk_path, 'topk', similarity_store.movie_ids_digest(range(100, 150)),
+                                             {'source': 'tags', 'max_features': 1000, 'weighting': 'count'})
+    base_file = open(topk_path, 'rb').read()
+
+    batches = [random_tags(rng, 4, WORDS[:20]), random_tags(rng, 3, WORDS[10:])]
+    for number, batch in enumerate(batches):
+        first_id = 200 + 10 * number
+        added, _ = similarity_store.append_movies(movies_path, topk_path, [
+            {'movie_id': first_id + i, 'title': f"New {first_id + i}", 'tags': text} for i, text in enumerate(batch)])
+        assert added == len(batch)
+
+    all_tags = tags + batches[0] + batches[1]
+    with open(movies_path, 'rb') as f:
+        movies = pickle.load(f)
+    assert list(movies['tags'].values()) == all_tags
+    movie_ids = list(movies['movie_id'].values())
+    assert movie_ids[50:] == [200, 201, 202, 203, 210, 211, 212]
+
+    # The base table is left alone, the delta carries every change since it was built
+    assert open(topk_path, 'rb').read() == base_file
+    delta = similarity_store.delta_path(topk_path)
+    assert similarity_store.check_top_k_delta(delta, similarity_store.movie_ids_digest(movie_ids)) == \
+        similarity_store.movie_ids_digest(range(100, 150))
+    base = similarity_store.open_artifact(topk_path, 'topk')
+    current = similarity_store.apply_top_k_delta(base, similarity_store.open_top_k_delta(delta))
+    assert_same_top_k((current.indices, current.scores), full_top_k(all_tags, 5, 'count'))
+
+
+def test_append_movies_rejects_known_movie_ids(tmp_path):
+    movies_path = str(tmp_path / 'movies.pkl')
+    with open(movies_path, 'wb') as f:
+        pickle.dump({'movie_id': {0: 100}, 'title': {0: "Movie"}, 'tags': {0: "drama"}}, f)
+
+    with pytest.raises(ValueError, match="already in"):
+        similarity_store.append_movies(movies_path, str(tmp_path / 'similarity_topk.npz'),
+                                       [{'movie_id': 100, 'title': "Again", 'tags': "drama"}])
+
+
+@pytest.fixture
+def symmetric_matrix():
+    # Row count not a multiple of the shard size, so the last shard is a partial one
+    rng = np.random.default_rng(5)
+    scores = rng.random((37, 37))
+    matrix = (scores + scores.T) / 2
+    np.fill_diagonal(matrix, 1.0)
+    return matrix
+
+
+ROWS = [0, 18, 36]
+
+
+def test_packed_rows_match_the_matrix(tmp_path, symmetric_matrix):
+    path = str(tmp_path / 'similarity_packed.npy')
+    similarity_store.save_packed(path, symmetric_matrix, block_size=8)
+    engine = similarity_store.open_packed(path)
+
+    assert len(engine) == len(symmetric_matrix)
+    for index in ROWS:
+        np.testing.assert_array_equal(engine.row(index), symmetric_matrix[index])
+    dense = similarity_store.DenseSimilarity(symmetric_matrix)
+    assert engine.neighbors(18, 5) == dense.neighbors(18, 5)
+
+
+def test_packed_rejects_an_incomplete_triangle():
+    with pytest.raises(ValueError, match="packed triangle"):
+        similarity_store.PackedSimilarity(np.zeros(10 * 11 // 2 + 1))
+
+
+@pytest.mark.parametrize('cache_size', [1, 8])
+def test_sharded_rows_match_the_matrix(tmp_path, symmetric_matrix, cache_size):
+    directory = str(tmp_path / 'similarity_shards')
+    assert similarity_store.save_sharded(directory, symmetric_matrix, rows_per_shard=10) == 4
+    engine = similarity_store.open_sharded(directory, cache_size=cache_size)
+
+    assert len(engine) == len(symmetric_matrix)
+    # Back and forth across shards, so a cache of one keeps swapping them
+    for index in ROWS + ROWS[::-1]:
+        np.testing.assert_array_equal(engine.row(index), symmetric_matrix[index])
+    assert len(engine._shards) == min(cache_size, 3)
+    dense = similarity_store.DenseSimilarity(symmetric_matrix)
+    assert engine.neighbors(36, 5) == dense.neighbors(36, 5)
+
+
+def test_sparse_rows_keep_the_scores_above_the_threshold(tmp_path, symmetric_matrix):
+    path = str(tmp_path / 'similarity_sparse.npz')
+    similarity_store.save_sparse(path, *similarity_store.build_sparse(symmetric_matrix, min_score=0.5, max_nnz=0,
+                                                                      block_size=8))
+    engine = similarity_store.open_sparse(path)
+
+    for index in ROWS:
+        expected = np.where(symmetric_matrix[index] > 0.5, symmetric_matrix[index], 0)
+        expected[index] = 0
+        np.testing.assert_array_equal(engine.row(index), expected)
+
+
+@pytest.mark.parametrize('max_nnz', [5, 0])
+def test_sparse_neighbors_match_the_matrix(symmetric_matrix, max_nnz):
+    engine = similarity_store.SparseSimilarity(*similarity_store.build_sparse(symmetric_matrix, max_nnz=max_nnz,
+                                                                              block_size=8))
+    dense = similarity_store.DenseSimilarity(symmetric_matrix)
+
+    for index in ROWS:
+        assert engine.neighbors(index, 5) == dense.neighbors(index, 5)
+    if max_nnz:
+        assert np.diff(engine.indptr).max() == max_nnz
+
+
+@pytest.mark.parametrize('precision', ['float16', 'uint8'])
+def test_quantized_rows_stay_within_their_precision(tmp_path, symmetric_matrix, precision):
+    path = str(tmp_path / f'similarity_{precision}.npy')
+    similarity_store.save_quantized(path, symmetric_matrix, precision, block_size=8)
+    engine = similarity_store.open_quantized(path)
+
+    assert engine.matrix.dtype == np.dtype(precision)
+    for index in ROWS:
+        row = symmetric_matrix[index]
+        # uint8 codes are at most half a step of the row's own range away
+        tolerance = 1e-3 if precision == 'float16' else (row.max() - row.min()) / 255 / 2 + 1e-6
+        np.testing.assert_allclose(engine.row(index), row, rtol=0, atol=tolerance)
+
+
+def test_uint8_keeps_a_constant_row(tmp_path, symmetric_matrix):
+    matrix = symmetric_matrix.copy()
+    matrix[18] = 0.25
+    path = str(tmp_path / 'similarity_uint8.npy')
+    similarity_store.save_quantized(path, matrix, 'uint8')
+
+    np.testing.assert_allclose(similarity_store.open_quantized(path).row(18), matrix[18], atol=1e-6)
+
+
+def test_new_segment_version_unlinks_the_previous_one():
+    prefix = f"similarity-test-{uuid.uuid4().hex[:12]}"
+    names = [f"{prefix}-{version}" for version in ('v1', 'v2')]
+    try:
+        for value, name in enumerate(names):
+            _, arrays = similarity_store.share_arrays(name, lambda: ({}, {'x': np.full(3, value)}), replaces=prefix)
+            assert arrays['x'].tolist() == [value] * 3
+
+        with pytest.raises(FileNotFoundError):
+            similarity_store.unlink_shared(names[0])
+        # The process that attached to the first version keeps reading it
+        _, arrays = similarity_store.share_arrays(names[0], lambda: pytest.fail("rebuilt"))
+        assert arrays['x'].tolist() == [0, 0, 0]
+    finally:
+        similarity_store.unlink_shared(names[1])
+        for path in glob.glob(os.path.join(tempfile.gettempdir(), prefix + '*')):
+            os.remove(path)
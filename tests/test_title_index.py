@@ -0,0 +1,70 @@
+import os
+import pickle
+import re
+
+import pytest
+
+from title_index import TitleIndex, normalize_title
+
+MOVIES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'movies.pkl')
+
+
+def test_normalize_title_ignores_case_and_whitespace():
+    assert normalize_title("  The  Dark\tKnight ") == normalize_title("the dark knight")
+    assert normalize_title("Amélie") == "amélie"
+    assert normalize_title("Alien") != normalize_title("Aliens")
+
+
+def test_unique_titles_are_offered_as_they_are():
+    index = TitleIndex(["Avatar", "Alien", "Up"], [19995, 348, 14160])
+
+    assert index.options == ["Avatar", "Alien", "Up"]
+    assert [index.position(option) for option in index.options] == [0, 1, 2]
+
+
+def test_lookup_is_case_and_whitespace_insensitive():
+    index = TitleIndex(["Avatar", "The Dark Knight"], [19995, 155])
+
+    assert index.position("  the dark   KNIGHT") == 1
+    with pytest.raises(KeyError):
+        index.position("The Dark Knight Rises")
+
+
+def test_titles_shared_by_different_movies_get_their_movie_id():
+    index = TitleIndex(["The Host", "Avatar", "the host"], [1255, 19995, 72710])
+
+    assert index.options == ["The Host (1255)", "Avatar", "the host (72710)"]
+    assert index.position("The Host (1255)") == 0
+    assert index.position("The Host (72710)") == 2
+    with pytest.raises(KeyError):
+        index.position("The Host")
+
+
+def test_repeated_movie_is_offered_once_at_its_first_row():
+    index = TitleIndex(["Batman", "Avatar", "Batman", "Batman"], [268, 19995, 2661, 268])
+
+    assert index.options == ["Batman (268)", "Avatar", "Batman (2661)"]
+    assert index.position("Batman (268)") == 0
+    assert index.position("Batman (2661)") == 2
+
+
+def test_label_matching_another_title_is_numbered():
+    index = TitleIndex(["Heat (42)", "Heat", "Heat"], [1, 42, 949])
+
+    assert index.options == ["Heat (42)", "Heat (42) #2", "Heat (949)"]
+    assert index.position("Heat (42)") == 0
+    assert index.position("Heat (42) #2") == 1
+
+
+def test_every_movie_of_the_catalog_can_be_picked():
+    with open(MOVIES_PATH, 'rb') as f:
+        movies = pickle.load(f)
+    titles, movie_ids = list(movies['title'].values()), list(movies['movie_id'].values())
+    index = TitleIndex(titles, movie_ids)
+
+    assert len(set(index.options)) == len(index.options)
+    assert len(index.options) == len(set(zip(map(normalize_title, titles), movie_ids)))
+    for option in index.options:
+        position = index.position(option)
+        assert option.startswith(titles[position])
+    assert not any(re.search(r' #\d+$', option) for option in index.options)
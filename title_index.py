@@ -0,0 +1,47 @@
+"""Lookup of the movie picked in the interface by its title
+
+The options offered to the user are built once from the movies table and
+each maps to the row position of its movie in the similarity data.
+"""
+from collections import defaultdict
+
+
+def normalize_title(title):
+    """Case and whitespace insensitive form of a title"""
+    return ' '.join(title.casefold().split())
+
+
+class TitleIndex:
+    """Row position of every movie by its title, built once when the movies are loaded
+
+    Titles shared by several movies get their movie_id appended, both in the
+    options offered to the user and in the lookup, so each one can be picked.
+    A movie listed more than once, repeating both title and movie_id, is
+    offered once and maps to its first row.
+    """
+
+    def __init__(self, titles, movie_ids):
+        movies_by_title = defaultdict(set)
+        for title, movie_id in zip(titles, movie_ids):
+            movies_by_title[normalize_title(title)].add(movie_id)
+
+        self.options = []
+        self.positions = {}
+        listed = set()
+        for position, (title, movie_id) in enumerate(zip(titles, movie_ids)):
+            key = normalize_title(title)
+            if (key, movie_id) in listed:
+                continue
+            listed.add((key, movie_id))
+
+            label = title if len(movies_by_title[key]) == 1 else f"{title} ({movie_id})"
+            # A label can still match the title of another movie, e.g. one really called "Title (42)"
+            option, number = label, 1
+            while normalize_title(option) in self.positions:
+                number += 1
+                option = f"{label} #{number}"
+            self.options.append(option)
+            self.positions[normalize_title(option)] = position
+
+    def position(self, option):
+        return self.positions[normalize_title(option)]